@@ -1,5 +1,7 @@
 from __main__ import vtk, qt, ctk, slicer
 import numpy
+import time
+import os
 #
 # Endoscopy
 #
@@ -31,15 +33,33 @@ class iGyneModelToTemplateRegistrationWidget:
     else:
       self.parent = parent
     self.layout = self.parent.layout()
+    # the registration code is only loaded once the module is opened
+    from iGyneModelToTemplateRegistrationLib.RegistrationLogic import RegistrationLogic
+    self.logic = RegistrationLogic()
+    self.registrationJob = None
+    self.stylusSampler = StylusSampler()
+    self.referenceAttachment = ReferenceAttachment()
+    self.landmarkButtons = []
+    self.templateSurface = None
+    self.templateSurfaceKey = None
+    self.surfaceIndex = None
+    self.surfaceIndexKey = None
+    self.surfaceLocator = None
+    self.surfaceLocatorKey = None
+    self.holeIndex = None
+    self.holeIndexKey = None
+    self.holeNames = []
+    self.liveDistance = LiveDistanceMonitor()
+    self.trackerRecorder = TrackerRecorder()
+    self.trackerReplay = TrackerReplay()
+    self.__cliNode = None
+    self.__cliObserverTag = None
     if not parent:
       self.setup()
       self.cameraNodeSelector.setMRMLScene(slicer.mrmlScene)
       self.inputFiducialsNodeSelector.setMRMLScene(slicer.mrmlScene)
       self.parent.show()
-    self.iterationNo = 0
-    self.numberOfFiducialPoints = 6
     self.RMS = 0
-    self.templateFiducialList = numpy.zeros((self.numberOfFiducialPoints,3)) 
   def setup(self):
     pointCollectionCollapsibleButton = ctk.ctkCollapsibleButton()
     pointCollectionCollapsibleButton.text = "Point Collection"
@@ -71,6 +91,43 @@ class iGyneModelToTemplateRegistrationWidget:
     self.stylusTrackerSelector.removeEnabled= False
     self.stylusTrackerSelector.connect('currentNodeChanged(bool)', self.enableOrDisablePointCollectionButton)
     pointCollectionFormLayout.addRow( stylusTrackerLabel, self.stylusTrackerSelector )
+    self.stylusTrackerSelector.connect('currentNodeChanged(vtkMRMLNode*)', self.stylusSampler.setTransformNode)
+
+    # Stylus tip averaging
+    averagingLabel = qt.QLabel( 'Averaging:' )
+    self.averagingMethodSelector = qt.QComboBox()
+    self.averagingMethodSelector.toolTip = "Robust average of the stylus tip samples within the averaging window."
+    self.averagingMethodSelector.addItem('Median')
+    self.averagingMethodSelector.addItem('Trimmed Mean')
+    pointCollectionFormLayout.addRow( averagingLabel, self.averagingMethodSelector)
+
+    averagingWindowLabel = qt.QLabel( 'Averaging Window (ms):' )
+    self.averagingWindowSpinBox = qt.QSpinBox()
+    self.averagingWindowSpinBox.toolTip = "Stylus tip samples younger than this are averaged into a point."
+    self.averagingWindowSpinBox.setRange(0, 5000)
+    self.averagingWindowSpinBox.value = 250
+    pointCollectionFormLayout.addRow( averagingWindowLabel, self.averagingWindowSpinBox)
+
+    # Dwell-triggered auto capture
+    self.autoCaptureCheckBox = qt.QCheckBox("Auto Capture")
+    self.autoCaptureCheckBox.toolTip = "Collect a point once the stylus tip has stayed still for the dwell time."
+    self.autoCaptureCheckBox.checked = False
+    self.autoCaptureCheckBox.connect('toggled(bool)', self.onAutoCaptureToggled)
+    pointCollectionFormLayout.addRow(self.autoCaptureCheckBox)
+
+    dwellTimeLabel = qt.QLabel( 'Dwell Time (ms):' )
+    self.dwellTimeSpinBox = qt.QSpinBox()
+    self.dwellTimeSpinBox.setRange(100, 10000)
+    self.dwellTimeSpinBox.value = 1000
+    self.dwellTimeSpinBox.connect('valueChanged(int)', self.onAutoCaptureToggled)
+    pointCollectionFormLayout.addRow( dwellTimeLabel, self.dwellTimeSpinBox)
+
+    dwellToleranceLabel = qt.QLabel( 'Dwell Tolerance (mm):' )
+    self.dwellToleranceSpinBox = qt.QDoubleSpinBox()
+    self.dwellToleranceSpinBox.setRange(0.1, 10.0)
+    self.dwellToleranceSpinBox.value = 0.5
+    self.dwellToleranceSpinBox.connect('valueChanged(double)', self.onAutoCaptureToggled)
+    pointCollectionFormLayout.addRow( dwellToleranceLabel, self.dwellToleranceSpinBox)
 
     # Point Collection button
     pointCollectionButton = qt.QPushButton("Collect Points")
@@ -89,47 +146,11 @@ class iGyneModelToTemplateRegistrationWidget:
     pointCollectionFormLayout.addRow(self.pointResetButton)
     self.pointResetButton.connect('clicked()', self.onPointResetButtonClicked)
 
-    #Radio Button 01
-    self.pointCollectedButton01= qt.QRadioButton("1: Ec O")
-    self.pointCollectedButton01.setAutoExclusive(False)
-    self.pointCollectedButton01.setDisabled(True)
-    self.pointCollectedButton01.setObjectName("pointCollectedButton01")
-    pointCollectionFormLayout.addRow(self.pointCollectedButton01)
-
-    #Radio Button 02
-    self.pointCollectedButton02= qt.QRadioButton("2: Ef I")
-    self.pointCollectedButton02.setAutoExclusive(False)
-    self.pointCollectedButton02.setDisabled(True)
-    self.pointCollectedButton02.setObjectName("pointCollectedButton02")
-    pointCollectionFormLayout.addRow(self.pointCollectedButton02)
-
-    #Radio Button 03
-    self.pointCollectedButton03= qt.QRadioButton("3: Ce I")
-    self.pointCollectedButton03.setAutoExclusive(False)
-    self.pointCollectedButton03.setDisabled(True)
-    self.pointCollectedButton03.setObjectName("pointCollectedButton03")
-    pointCollectionFormLayout.addRow(self.pointCollectedButton03)
-    
-    #Radio Button 04
-    self.pointCollectedButton04= qt.QRadioButton("4: Cn O")
-    self.pointCollectedButton04.setAutoExclusive(False)
-    self.pointCollectedButton04.setDisabled(True)
-    self.pointCollectedButton04.setObjectName("pointCollectedButton04")
-    pointCollectionFormLayout.addRow(self.pointCollectedButton04)
-
-    #Radio Button 05
-    self.pointCollectedButton05= qt.QRadioButton("5: Eb O")
-    self.pointCollectedButton05.setAutoExclusive(False)
-    self.pointCollectedButton05.setDisabled(True)
-    self.pointCollectedButton05.setObjectName("pointCollectedButton05")
-    pointCollectionFormLayout.addRow(self.pointCollectedButton05)
-
-    #Radio Button 06
-    self.pointCollectedButton06= qt.QRadioButton("6: Eb I")
-    self.pointCollectedButton06.setAutoExclusive(False)
-    self.pointCollectedButton06.setDisabled(True)
-    self.pointCollectedButton06.setObjectName("pointCollectedButton06")
-    pointCollectionFormLayout.addRow(self.pointCollectedButton06)
+    # Landmark status, one radio button per landmark of the template definition
+    self.landmarkStatusFrame = qt.QFrame()
+    self.landmarkStatusFrame.setLayout(qt.QVBoxLayout())
+    pointCollectionFormLayout.addRow(self.landmarkStatusFrame)
+    self.buildLandmarkButtons()
 
 
     # Registration collapsible button
@@ -144,7 +165,7 @@ class iGyneModelToTemplateRegistrationWidget:
     modelFiducialsLabel= qt.QLabel( 'Model Fiducial List:' )
     self.modelFiducialSelector= slicer.qMRMLNodeComboBox()
     self.modelFiducialSelector.toolTip = "Choose the baseline scan"
-    self.modelFiducialSelector.nodeTypes = ['vtkMRMLAnnotationHierarchyNode']
+    self.modelFiducialSelector.nodeTypes = ['vtkMRMLAnnotationHierarchyNode', 'vtkMRMLMarkupsFiducialNode']
     self.modelFiducialSelector.setMRMLScene(slicer.mrmlScene)
     self.modelFiducialSelector.addEnabled = False
     self.modelFiducialSelector.noneEnabled= True
@@ -152,6 +173,46 @@ class iGyneModelToTemplateRegistrationWidget:
     self.modelFiducialSelector.connect('currentNodeChanged(bool)', self.enableOrDisableRegistrationButton)
     registrationFormLayout.addRow( modelFiducialsLabel, self.modelFiducialSelector) 
 
+    # Transform type selector
+    transformTypeLabel = qt.QLabel( 'Transform Type:' )
+    self.transformTypeSelector = qt.QComboBox()
+    self.transformTypeSelector.toolTip = "Rigid keeps the model size, Similarity also estimates an isotropic scale."
+    self.transformTypeSelector.addItem('Rigid')
+    self.transformTypeSelector.addItem('Similarity')
+    registrationFormLayout.addRow( transformTypeLabel, self.transformTypeSelector)
+
+    # Fiducial registration CLI fallback
+    self.useCLICheckBox = qt.QCheckBox("Use Fiducial Registration CLI")
+    self.useCLICheckBox.toolTip = "Run the fiducialregistration CLI module instead of the built-in landmark solver."
+    self.useCLICheckBox.checked = False
+    registrationFormLayout.addRow(self.useCLICheckBox)
+
+    # Provisional registration display
+    self.showProvisionalCheckBox = qt.QCheckBox("Show Provisional Registration")
+    self.showProvisionalCheckBox.toolTip = "Update ModelToTemplateTransform from the third collected point on."
+    self.showProvisionalCheckBox.checked = False
+    registrationFormLayout.addRow(self.showProvisionalCheckBox)
+
+    # Automatic landmark correspondence
+    self.autoCorrespondenceCheckBox = qt.QCheckBox("Automatic Correspondence")
+    self.autoCorrespondenceCheckBox.toolTip = "Match the model fiducials to the collected points by their geometry instead of their order."
+    self.autoCorrespondenceCheckBox.checked = False
+    self.correspondenceLabel = qt.QLabel('')
+    registrationFormLayout.addRow(self.autoCorrespondenceCheckBox, self.correspondenceLabel)
+
+    # Surface refinement
+    self.surfaceRefinementCheckBox = qt.QCheckBox("Surface Refinement (ICP)")
+    self.surfaceRefinementCheckBox.toolTip = "Refine the landmark registration by fitting the stylus sweep and the landmarks to the template surface. Needs a sweep of at least 100 points."
+    self.surfaceRefinementCheckBox.checked = False
+    registrationFormLayout.addRow(self.surfaceRefinementCheckBox)
+
+    self.sweepButton = qt.QPushButton("Record Stylus Sweep")
+    self.sweepButton.toolTip = "Record stylus tip positions while the stylus is slid over the template surface."
+    self.sweepButton.checkable = True
+    self.sweepButton.connect('toggled(bool)', self.onSweepButtonToggled)
+    self.sweepLabel = qt.QLabel('0 points')
+    registrationFormLayout.addRow(self.sweepButton, self.sweepLabel)
+
     # Registration button
     registrationButton = qt.QPushButton("Register")
     registrationButton.toolTip = "Performs a Landmark Registration."
@@ -161,6 +222,48 @@ class iGyneModelToTemplateRegistrationWidget:
     # Set local var as instance attribute
     self.registrationButton= registrationButton
 
+    # Registration progress and status
+    self.registrationProgressBar = qt.QProgressBar()
+    self.registrationProgressBar.setRange(0, 100)
+    self.registrationProgressBar.visible = False
+    registrationFormLayout.addRow(self.registrationProgressBar)
+    self.registrationStatusLabel = qt.QLabel('Idle')
+    registrationFormLayout.addRow( 'Status:', self.registrationStatusLabel)
+    self.diagnosticsLabel = qt.QLabel('')
+    self.diagnosticsLabel.wordWrap = True
+    registrationFormLayout.addRow( 'Diagnostics:', self.diagnosticsLabel)
+
+    # Predicted target registration error
+    self.targetErrorCheckBox = qt.QCheckBox("Target Registration Error Map")
+    self.targetErrorCheckBox.toolTip = "Color the template by the predicted target registration error of the landmark configuration after each registration."
+    self.targetErrorCheckBox.checked = True
+    registrationFormLayout.addRow(self.targetErrorCheckBox)
+
+    localizationErrorLabel = qt.QLabel( 'Localization Error (mm):' )
+    self.localizationErrorSpinBox = qt.QDoubleSpinBox()
+    self.localizationErrorSpinBox.toolTip = "RMS fiducial localization error of the stylus. At 0 it is estimated from the registration RMS."
+    self.localizationErrorSpinBox.setRange(0.0, 10.0)
+    self.localizationErrorSpinBox.singleStep = 0.1
+    self.localizationErrorSpinBox.specialValueText = 'From RMS'
+    self.localizationErrorSpinBox.value = 0.0
+    registrationFormLayout.addRow( localizationErrorLabel, self.localizationErrorSpinBox)
+    self.targetErrorLabel = qt.QLabel('')
+    self.targetErrorLabel.wordWrap = True
+    registrationFormLayout.addRow( 'Predicted TRE:', self.targetErrorLabel)
+
+    # Polls the background registration job from the main thread
+    self.registrationTimer = qt.QTimer()
+    self.registrationTimer.setInterval(20)
+    self.registrationTimer.connect('timeout()', self.onRegistrationTimer)
+
+    # A change of any registration input makes a running job stale
+    self.templateSelector.connect('currentNodeChanged(bool)', self.cancelRegistration)
+    self.stylusTrackerSelector.connect('currentNodeChanged(bool)', self.cancelRegistration)
+    self.modelFiducialSelector.connect('currentNodeChanged(bool)', self.cancelRegistration)
+    self.transformTypeSelector.connect('currentIndexChanged(int)', self.cancelRegistration)
+    self.templateSelector.connect('currentNodeChanged(bool)', self.resetProvisionalRegistration)
+    self.modelFiducialSelector.connect('currentNodeChanged(bool)', self.onModelFiducialsChanged)
+    self.transformTypeSelector.connect('currentIndexChanged(int)', self.updateProvisionalRegistration)
 
 
     # Reference Attachment collapsible button
@@ -195,6 +298,23 @@ class iGyneModelToTemplateRegistrationWidget:
     self.childNodeSelector.connect('currentNodeChanged(bool)', self.enableOrDisableAttachButton)
     referenceAttachmentFormLayout.addRow( childNodeLabel, self.childNodeSelector) 
 
+    # Coalesced propagation of the reference tracker
+    self.coalesceCheckBox = qt.QCheckBox("Coalesce Tracker Updates")
+    self.coalesceCheckBox.toolTip = "Push reference tracker updates to the attached nodes at most once per frame instead of parenting them under the reference."
+    self.coalesceCheckBox.checked = True
+    referenceAttachmentFormLayout.addRow(self.coalesceCheckBox)
+
+    maximumRateLabel = qt.QLabel( 'Maximum Update Rate (Hz):' )
+    self.maximumRateSpinBox = qt.QSpinBox()
+    self.maximumRateSpinBox.setRange(1, 240)
+    self.maximumRateSpinBox.value = 60
+    self.maximumRateSpinBox.connect('valueChanged(int)', self.referenceAttachment.setMaximumRate)
+    referenceAttachmentFormLayout.addRow( maximumRateLabel, self.maximumRateSpinBox)
+
+    self.attachmentStatusLabel = qt.QLabel('')
+    referenceAttachmentFormLayout.addRow( 'Updates:', self.attachmentStatusLabel)
+    self.referenceAttachment.pushCallback = self.updateAttachmentStatus
+
     # Attach button
     attachButton = qt.QPushButton("Attach")
     attachButton.toolTip = "Register model and image to the reference sensor."
@@ -205,22 +325,100 @@ class iGyneModelToTemplateRegistrationWidget:
     self.attachButton= attachButton 
 
 
+    # Live distance collapsible button
+    self.liveDistanceCollapsibleButton = ctk.ctkCollapsibleButton()
+    self.liveDistanceCollapsibleButton.text = "Live Distance"
+    self.layout.addWidget(self.liveDistanceCollapsibleButton)
+    # Layout within the live distance collapsible button
+    liveDistanceFormLayout = qt.QFormLayout(self.liveDistanceCollapsibleButton)
+
+    holesLabel= qt.QLabel( 'Needle Holes:' )
+    self.holesSelector= slicer.qMRMLNodeComboBox()
+    self.holesSelector.toolTip = "Choose the needle hole positions, in template model coordinates"
+    self.holesSelector.nodeTypes = ['vtkMRMLAnnotationHierarchyNode', 'vtkMRMLMarkupsFiducialNode']
+    self.holesSelector.setMRMLScene(slicer.mrmlScene)
+    self.holesSelector.addEnabled = False
+    self.holesSelector.noneEnabled= True
+    self.holesSelector.removeEnabled= False
+    liveDistanceFormLayout.addRow( holesLabel, self.holesSelector)
+
+    self.liveDistanceButton = qt.QPushButton("Monitor Stylus Tip")
+    self.liveDistanceButton.toolTip = "Show the distance of the stylus tip to the template surface and to the nearest needle hole on every tracker update."
+    self.liveDistanceButton.checkable = True
+    self.liveDistanceButton.connect('toggled(bool)', self.onLiveDistanceToggled)
+    liveDistanceFormLayout.addRow(self.liveDistanceButton)
+
+    self.surfaceDistanceLabel = qt.QLabel('')
+    liveDistanceFormLayout.addRow( 'Surface Distance:', self.surfaceDistanceLabel)
+    self.holeDistanceLabel = qt.QLabel('')
+    liveDistanceFormLayout.addRow( 'Nearest Hole:', self.holeDistanceLabel)
+    self.latencyLabel = qt.QLabel('')
+    liveDistanceFormLayout.addRow( 'Latency:', self.latencyLabel)
+    self.liveDistance.displayCallback = self.updateLiveDistance
+
+    self.templateSelector.connect('currentNodeChanged(bool)', self.stopLiveDistance)
+    self.stylusTrackerSelector.connect('currentNodeChanged(bool)', self.stopLiveDistance)
+
+
+    # Recording collapsible button
+    self.recordingCollapsibleButton = ctk.ctkCollapsibleButton()
+    self.recordingCollapsibleButton.text = "Tracker Recording"
+    self.recordingCollapsibleButton.collapsed = True
+    self.layout.addWidget(self.recordingCollapsibleButton)
+    # Layout within the recording collapsible button
+    recordingFormLayout = qt.QFormLayout(self.recordingCollapsibleButton)
+
+    recordingPathLabel = qt.QLabel( 'Session File:' )
+    self.recordingPathEdit = qt.QLineEdit()
+    self.recordingPathEdit.toolTip = "Binary file the stylus and reference tracker streams are recorded to and replayed from."
+    self.recordingPathEdit.text = os.path.join(slicer.app.temporaryPath, 'iGyneTrackerSession.trk')
+    recordingFormLayout.addRow( recordingPathLabel, self.recordingPathEdit)
+
+    self.recordButton = qt.QPushButton("Record Trackers")
+    self.recordButton.toolTip = "Record every update of the stylus and reference transform nodes."
+    self.recordButton.checkable = True
+    self.recordButton.connect('toggled(bool)', self.onRecordButtonToggled)
+    recordingFormLayout.addRow(self.recordButton)
+
+    replaySpeedLabel = qt.QLabel( 'Replay Speed:' )
+    self.replaySpeedSelector = qt.QComboBox()
+    self.replaySpeedSelector.toolTip = "Replay in real time, faster than real time, or as fast as possible."
+    for speed in ('1x', '2x', '5x', '10x', 'Max'):
+      self.replaySpeedSelector.addItem(speed)
+    recordingFormLayout.addRow( replaySpeedLabel, self.replaySpeedSelector)
+
+    self.replayButton = qt.QPushButton("Replay Trackers")
+    self.replayButton.toolTip = "Drive the selected stylus and reference transform nodes from the session file."
+    self.replayButton.checkable = True
+    self.replayButton.connect('toggled(bool)', self.onReplayButtonToggled)
+    recordingFormLayout.addRow(self.replayButton)
+
+    self.saveSessionButton = qt.QPushButton("Save Session")
+    self.saveSessionButton.toolTip = "Save the landmarks and the stylus sweep next to the session file, for batch registration."
+    self.saveSessionButton.connect('clicked()', self.onSaveSessionButtonClicked)
+    recordingFormLayout.addRow(self.saveSessionButton)
+
+    self.recordingStatusLabel = qt.QLabel('')
+    recordingFormLayout.addRow( 'Status:', self.recordingStatusLabel)
+    self.trackerReplay.finishedCallback = self.onReplayFinished
+
 
     self.scene = slicer.mrmlScene
-    self.logic = slicer.modules.annotations.logic()
-    #self.logic.AddHierarchy
-    # a=self.logic.GetActiveHierarchyNode()
-    # a.SetName('Template Fiducials')
+    nodeRegistry.setScene(self.scene)
     
   def enableOrDisablePointCollectionButton(self):
     """Connected to both the fiducial and camera node selector. It allows to 
     enable or disable the 'create path' button."""
     self.pointCollectionButton.enabled = self.stylusTrackerSelector.currentNode() != None and self.templateSelector.currentNode() != None 
+    # the model fiducial list defines the landmarks, so it is chosen before collecting
+    if self.pointCollectionButton.enabled:
+      self.registrationCollapsibleButton.enabled = True
 
   def enableOrDisableRegistrationButton(self):
     """Connected to both the fiducial and camera node selector. It allows to 
     enable or disable the 'create path' button."""
-    self.registrationButton.enabled = self.modelFiducialSelector.currentNode() != None 
+    landmarks = self.logic.landmarks
+    self.registrationButton.enabled = self.modelFiducialSelector.currentNode() != None and landmarks.numberOfCollectedPoints() >= len(landmarks)
 
   def enableOrDisableAttachButton(self):
     """Connected to both the fiducial and camera node selector. It allows to 
@@ -229,85 +427,93 @@ class iGyneModelToTemplateRegistrationWidget:
 
 
 
+  def buildLandmarkButtons(self):
+    """(Re)creates the landmark status radio buttons from the landmark names."""
+    layout = self.landmarkStatusFrame.layout()
+    for button in self.landmarkButtons:
+      layout.removeWidget(button)
+      button.deleteLater()
+    self.landmarkButtons = []
+    for i, name in enumerate(self.logic.landmarks.names):
+      button = qt.QRadioButton("%d: %s" % (i+1, name))
+      button.setAutoExclusive(False)
+      button.setDisabled(True)
+      button.setObjectName("pointCollectedButton%02d" % (i+1))
+      layout.addWidget(button)
+      self.landmarkButtons.append(button)
+
+  def defineLandmarks(self, names):
+    """Switches to a new template definition, only before collection started."""
+    if self.logic.landmarks.numberOfCollectedPoints() > 0 or list(names) == self.logic.landmarks.names:
+      return
+    self.logic.defineLandmarks(names)
+    self.buildLandmarkButtons()
+
+  def onAutoCaptureToggled(self):
+    """Arms or disarms the dwell trigger of the stylus sampler."""
+    if self.autoCaptureCheckBox.checked:
+      self.stylusSampler.setDwellCapture(self.onStylusDwell, self.dwellTimeSpinBox.value / 1000.0, self.dwellToleranceSpinBox.value)
+    else:
+      self.stylusSampler.setDwellCapture(None)
+
+  def onStylusDwell(self):
+    # collect outside of the transform node observer
+    if self.pointCollectionButton.enabled:
+      qt.QTimer.singleShot(0, self.onPointCollectionButtonClicked)
+
   def onPointCollectionButtonClicked(self):
     """Connected to 'create path' button. It allows to:
       - compute the path
       - create the associated model"""
-    listExitence = False
-    hierarchyNodes = slicer.util.getNodes('vtkMRMLAnnotationHierarchyNode*')
-    for hierarchyNode in hierarchyNodes.keys():
-      if hierarchyNode=='Template Fiducials':
-        listExitence = True
-    if listExitence == False:
-      templateFiducialAnnotationList = slicer.vtkMRMLAnnotationHierarchyNode()
-      templateFiducialAnnotationList.SetName('Template Fiducials')
-      templateFiducialAnnotationList.SetHideFromEditors(0)
-      templateFiducialAnnotationList.SetScene(self.scene)
-      self.scene.AddNode(templateFiducialAnnotationList)
-      self.templateFiducialAnnotationList = templateFiducialAnnotationList
-
-    self.logic.SetActiveHierarchyNodeID(self.templateFiducialAnnotationList.GetID())
-
-    if self.iterationNo < self.numberOfFiducialPoints:
-      self.templateFiducialList[self.iterationNo] = self.collect()
-      if self.iterationNo == self.numberOfFiducialPoints-1:
+    self.cancelRegistration()
+
+    self.registrationCollapsibleButton.enabled = True
+    landmarks = self.logic.landmarks
+    index = landmarks.nextIndex()
+    if index < len(landmarks):
+      self.logic.collectPoint(index, self.collect(index), self.stylusSampler.clock())
+      if index < len(self.landmarkButtons):
+        self.landmarkButtons[index].setChecked(1)
+      self.updateProvisionalRegistration()
+      if landmarks.numberOfCollectedPoints() == len(landmarks):
         print "Point collection Finished Succesfullly, the Fiducial Coordinates are:"
-        print self.templateFiducialList
-        self.registrationCollapsibleButton.enabled = True
+        print landmarks.coordinates()
         self.pointCollectionButton.enabled = False 
         self.pointResetButton.enabled = True
-    self.iterationNo += 1
+    self.enableOrDisableRegistrationButton()
 
 
   def onPointResetButtonClicked(self):
     """Connected to 'create path' button. It allows to:"""
-    self.iterationNo = 0
+    self.cancelRegistration()
     self.pointCollectionButton.enabled = True
     self.pointResetButton.enabled = False
-    self.templateFiducialList = numpy.zeros((self.numberOfFiducialPoints,3))    
-    self.pointCollectedButton01.setChecked(0)
-    self.pointCollectedButton02.setChecked(0)
-    self.pointCollectedButton03.setChecked(0)
-    self.pointCollectedButton04.setChecked(0)
-    self.pointCollectedButton05.setChecked(0)
-    self.pointCollectedButton06.setChecked(0)
-    self.fiducialAnnotationListNode = slicer.util.getNode('Template Fiducials')
-    self.fiducialAnnotationListNode.RemoveAllChildrenNodes()
-    #self.scene.RemoveNode(self.templateFiducialAnnotationList)
+    self.logic.resetCollection()
+    # a model fiducial list chosen while collecting defines the landmarks now
+    self.onModelFiducialsChanged()
+    self.enableOrDisableRegistrationButton()
+    for button in self.landmarkButtons:
+      button.setChecked(0)
+    self.getPointSetNode('Template Fiducials').RemoveAllMarkups()
     
-  def collect(self):
+  def collect(self, index):
+    """Reads the stylus tip and stores it in place in the template fiducials."""
     fiducialsNode = self.readStylusTipPosition()
-    #print "Getting the point..." 
-    fiducial = slicer.vtkMRMLAnnotationFiducialNode()
-    fiducialName = "T" + str(self.iterationNo)
-    fiducial.SetName(fiducialName)
-    fiducial.SetFiducialCoordinates(fiducialsNode)
-    fiducial.Initialize(slicer.mrmlScene)
-    #fiducial.SetHideFromEditors()
+    setPointSetPoint(self.getPointSetNode('Template Fiducials'), index, fiducialsNode, self.logic.landmarks.names[index])
     return fiducialsNode
 
   def readStylusTipPosition(self):
+    from iGyneModelToTemplateRegistrationLib.Instrumentation import stageTimer
+    start = time.time()
     tempFiducialsNode = self.stylusTrackerSelector.currentNode()
-    xCoordinate = tempFiducialsNode.GetMatrixTransformToParent().GetElement(0,3)
-    yCoordinate = tempFiducialsNode.GetMatrixTransformToParent().GetElement(1,3)
-    zCoordinate = tempFiducialsNode.GetMatrixTransformToParent().GetElement(2,3)
-    self.Coordinate = ([xCoordinate, yCoordinate, zCoordinate])
-    transformPositions = self.Coordinate
-    self.fiducial = slicer.vtkMRMLAnnotationFiducialNode()
-    
-      
-    if (self.iterationNo==0):  
-      self.pointCollectedButton01.setChecked(1)
-    elif (self.iterationNo==1):  
-      self.pointCollectedButton02.setChecked(1)
-    elif (self.iterationNo==2):  
-      self.pointCollectedButton03.setChecked(1)
-    elif (self.iterationNo==3):  
-      self.pointCollectedButton04.setChecked(1)
-    elif (self.iterationNo==4):  
-      self.pointCollectedButton05.setChecked(1)
-    elif (self.iterationNo==5):  
-      self.pointCollectedButton06.setChecked(1)
+    method = 'trimmed' if self.averagingMethodSelector.currentText == 'Trimmed Mean' else 'median'
+    tipPosition = self.stylusSampler.tipPosition(self.averagingWindowSpinBox.value / 1000.0, method)
+    if tipPosition is None:
+      # no samples yet, the tracker has not moved since the stylus was selected
+      m = tempFiducialsNode.GetMatrixTransformToParent()
+      tipPosition = [m.GetElement(0,3), m.GetElement(1,3), m.GetElement(2,3)]
+    self.Coordinate = list(tipPosition)
+    stageTimer.record('stylus read', time.time() - start)
 
     #print transformPositions
     
@@ -317,126 +523,1232 @@ class iGyneModelToTemplateRegistrationWidget:
     print "Hello Registration :) "
     self.referenceAttachmentCollapsibleButton.enabled = True
     
-    linearTransformExistence = False
-    linearTransformNodes = slicer.util.getNodes('vtkMRMLlinearTransformNode*')
-    for linearTransformNode in linearTransformNodes.keys():
-      if linearTransformNode=='ModelToTemplateTransform':
-        linearTransformExistence = True
-    if linearTransformExistence == False:
-      followupTransform = slicer.vtkMRMLLinearTransformNode()
-      followupTransform.SetName('ModelToTemplateTransform')
-      followupTransform.SetScene(slicer.mrmlScene)
-      slicer.mrmlScene.AddNode(followupTransform)
-      self.followupTransform = followupTransform
-
-    self.fiducialListNode = slicer.util.getNode('Template Fiducials')
-    movingLandmarksListID = self.fiducialListNode.GetID()
-    
-    
-
-    modelFiducials = self.modelFiducialSelector.currentNode()
-    
-    
-    
-    # extracting the effects of transform parameters
-    transformNode1 = self.templateSelector.currentNode().GetParentTransformNode()
-    #print transformNode1
-    shiftTransform1 = [0 , 0, 0]
-    rotationTransform1 = [[1, 0,0],[0,1,0],[0,0,1]]
-    #shiftTransform2 = [0, 0, 0]
-    #rotationTransform2 = [1, 0,0],[0,1,0],[0,0,1]]
-    if transformNode1 != None:
-      m = vtk.vtkMatrix4x4()
-      transformNode1.GetMatrixTransformToWorld(m)
-      shiftTransform1 = [ m.GetElement(0,3), m.GetElement(1,3), m.GetElement(2,3) ]
-      rotationTransform1 = [[m.GetElement(0,0), m.GetElement(0,1),m.GetElement(0,2)],[m.GetElement(1,0), m.GetElement(1,1),m.GetElement(1,2)],[m.GetElement(2,0), m.GetElement(2,1),m.GetElement(2,2)]]
-      #transformNode2 = transformNode1.GetParentTransformNode()
-      #if transformNode2 != None:
-        #transformNode2.GetMatrixTransformToWorld(m)
-        #shiftTransform2 = [ m.GetElement(0,3), m.GetElement(1,3), m.GetElement(2,3) ]
-        #rotationTransform2 = [[m.GetElement(0,0), m.GetElement(0,1),m.GetElement(0,2)],[m.GetElement(1,0), m.GetElement(1,1),m.GetElement(1,2)],[m.GetElement(2,0), m.GetElement(2,1),m.GetElement(2,2)]
-    #shiftTransform = numpy.add(shiftTransform1,shiftTransform2)
+    # one scene refresh for all the node changes of this registration
+    self.scene.StartState(slicer.vtkMRMLScene.BatchProcessState)
+    try:
+      self.getModelToTemplateTransform()
+      movingLandmarksListID = self.getPointSetNode('Template Fiducials').GetID()
 
-    
-    
-    # Changing the fiducial coordinates according to the transform
-    
-    if modelFiducials.GetClassName() == "vtkMRMLAnnotationHierarchyNode":
-    # slicer4 style hierarchy nodes
-      collection = vtk.vtkCollection()
-      modelFiducials.GetChildrenDisplayableNodes(collection)
-      n = collection.GetNumberOfItems()
-    
-    
-    if n != 6: 
+      p = self.readModelFiducialList()
+      if p is None:
         return
-      # output an error and ask user to select a fiducial with 6 points
-    listExitence = False
-    hierarchyNodes = slicer.util.getNodes('vtkMRMLAnnotationHierarchyNode*')
-    for hierarchyNode in hierarchyNodes.keys():
-      if hierarchyNode=='New Model Fiducials':
-        listExitence = True
-        self.newModelFiducialAnnotationList.RemoveAllChildrenNodes()
-    if listExitence == False:
-      newModelFiducialAnnotationList = slicer.vtkMRMLAnnotationHierarchyNode()
-      newModelFiducialAnnotationList.SetName('New Model Fiducials')
+      if self.autoCorrespondenceCheckBox.checked:
+        p = self.matchModelFiducials(p)
+        if p is None:
+          return
       # hide the fiducial list from the scene
-      newModelFiducialAnnotationList.SetHideFromEditors(1)
-      newModelFiducialAnnotationList.SetScene(self.scene)
-      self.scene.AddNode(newModelFiducialAnnotationList)
-      self.newModelFiducialAnnotationList = newModelFiducialAnnotationList
+      newModelFiducials = self.getPointSetNode('New Model Fiducials', hidden=True)
+      setPointSetCoordinates(newModelFiducials, p, self.logic.landmarks.names)
+      fixedLandmarksListID = newModelFiducials.GetID()
+    finally:
+      self.scene.EndState(slicer.vtkMRMLScene.BatchProcessState)
+
+    self.cancelRegistration()
+    similarity = self.transformTypeSelector.currentText == 'Similarity'
+    if self.useCLICheckBox.checked:
+      self.logic.fixedLandmarks = p
+      self.runCLIRegistration(fixedLandmarksListID, movingLandmarksListID)
+    elif self.surfaceRefinementCheckBox.checked:
+      self.registrationJob = self.logic.createRegistrationJob(p, similarity, self.getTemplateSurfaceIndex())
+      self.registrationJob.start()
+      self.registrationTimer.start()
+    elif self.logic.canSolveIncrementally(p):
+      # the running sums already cover every landmark pair
+      matrix, self.RMS, self.residuals = self.logic.register(p, similarity)
+      setTransformNodeMatrix(self.followupTransform, matrix)
+      self.finishRegistration()
+      return
+    else:
+      self.registrationJob = self.logic.createRegistrationJob(p, similarity)
+      self.registrationJob.start()
+      self.registrationTimer.start()
+    self.setRegistrationStatus('Registering ...', 0)
+
+  def matchModelFiducials(self, p):
+    """Reorders the model fiducials to match the collected landmarks, or 
+    returns None when no consistent assignment exists. When another 
+    assignment fits almost as well, the list order is kept."""
+    from iGyneModelToTemplateRegistrationLib.Instrumentation import stageTimer
+    similarity = self.transformTypeSelector.currentText == 'Similarity'
+    start = time.time()
+    match = self.logic.matchCorrespondence(p, similarity)
+    stageTimer.record('correspondence', time.time() - start)
+    if match is None:
+      self.correspondenceLabel.text = 'No consistent assignment found'
+      self.setRegistrationStatus('Registration failed: no landmark correspondence')
+      return None
+    permutation, rms, margin = match
+    if margin < 1.0:
+      # a symmetric landmark layout fits more than one assignment equally 
+      # well, a guess between them could swap landmarks unnoticed
+      print "Ambiguous landmark correspondence, keeping the list order"
+      self.correspondenceLabel.text = 'Ambiguous, margin %.1f mm, list order kept' % margin
+      return p
+    print "Model fiducial matched to each collected landmark:", permutation
+    if numpy.array_equal(permutation, numpy.arange(len(p))):
+      self.correspondenceLabel.text = 'In order, margin %.1f mm' % margin
+    else:
+      self.correspondenceLabel.text = 'Reordered, margin %.1f mm' % margin
+    return p[permutation]
+
+  def onSweepButtonToggled(self, checked):
+    """Records the stylus sweep in its own sampler buffer, apart from the 
+    ring buffer of the landmark averaging."""
+    if checked:
+      self.stylusSampler.startRecording()
+      self.sweepButton.text = "Stop Stylus Sweep"
+      return
+    self.sweepButton.text = "Record Stylus Sweep"
+    if self.stylusSampler.recording is None:
+      return
+    self.logic.sweepPoints, dropped = self.stylusSampler.stopRecording()
+    self.sweepLabel.text = '%d points' % len(self.logic.sweepPoints)
+    if dropped > 0:
+      print "Stylus sweep is limited to %d points, %d later points were dropped" % (self.stylusSampler.maximumRecording, dropped)
+      self.sweepLabel.text += ', %d dropped' % dropped
+
+  def templateToWorldMatrix(self):
+    """4x4 numpy matrix of the whole transform chain above the template 
+    model, read once from the scene."""
+    from iGyneModelToTemplateRegistrationLib.Instrumentation import stageTimer
+    start = time.time()
+    matrix = self.readTemplateToWorldMatrix()
+    stageTimer.record('transform chain', time.time() - start)
+    return matrix
 
-    self.logic.SetActiveHierarchyNodeID(self.newModelFiducialAnnotationList.GetID())
+  def readTemplateToWorldMatrix(self):
+    # not timed on its own, the live distance reads it on every tracker update
+    transformNode = self.templateSelector.currentNode().GetParentTransformNode()
+    if transformNode == None:
+      return numpy.identity(4)
+    m = vtk.vtkMatrix4x4()
+    transformNode.GetMatrixTransformToWorld(m)
+    return arrayFromVTKMatrix(m)
 
+  def getTemplateSurface(self):
+    """Vertices and vertex normals of the template in template model 
+    coordinates, recomputed only when the template or its points change."""
+    templateNode = self.templateSelector.currentNode()
+    polyData = templateNode.GetPolyData()
+    if polyData == None or polyData.GetNumberOfPoints() == 0:
+      return None
+    # the points MTime, as scalar arrays added to the polydata do not move the surface
+    key = (templateNode.GetID(), polyData.GetPoints().GetMTime())
+    if key != self.templateSurfaceKey:
+      self.templateSurface = polyDataPointsAndNormals(polyData)
+      self.templateSurfaceKey = key
+    return self.templateSurface
 
+  def getTemplateSurfaceIndex(self, worldMatrix=None):
+    """Spatial index of the template surface in world coordinates for the 
+    surface refinement, rebuilt only when the template, its points or its 
+    transforms have changed."""
+    surface = self.getTemplateSurface()
+    if surface is None:
+      return None
+    if worldMatrix is None:
+      worldMatrix = self.templateToWorldMatrix()
+    key = (self.templateSurfaceKey, worldMatrix.tostring())
+    if key != self.surfaceIndexKey:
+      points, normals = surface
+      self.surfaceIndex = self.logic.surfaceIndex(points, normals, worldMatrix)
+      self.surfaceIndexKey = key
+    return self.surfaceIndex
 
-    #self.logic.AddHierarchy
-    #a=self.logic.GetActiveHierarchyNode()
-    #a.SetName('New Model Fiducials')
+  def getTemplateSurfaceLocator(self):
+    """Cell locator of the template surface in template model coordinates, 
+    for the closest point on its cells rather than the closest vertex. It 
+    does not depend on the transforms above the template, so it is only 
+    rebuilt when the template or its points change."""
+    templateNode = self.templateSelector.currentNode()
+    polyData = templateNode.GetPolyData()
+    if polyData == None or polyData.GetNumberOfCells() == 0:
+      return None
+    key = (templateNode.GetID(), polyData.GetPoints().GetMTime())
+    if key != self.surfaceLocatorKey:
+      self.surfaceLocator = vtk.vtkCellLocator()
+      self.surfaceLocator.SetDataSet(polyData)
+      self.surfaceLocator.BuildLocator()
+      self.surfaceLocatorKey = key
+    return self.surfaceLocator
+
+  def getLiveDistanceIndices(self):
+    """Template surface locator, needle hole index and hole names, all in 
+    template model coordinates, and the template to world matrix for the 
+    live distance readout. Moving the template does not rebuild the 
+    locator or the index, so this is cheap enough to be called on every 
+    tracker update."""
+    if self.templateSelector.currentNode() == None:
+      return None, None, [], None
+    worldMatrix = self.readTemplateToWorldMatrix()
+    surfaceLocator = self.getTemplateSurfaceLocator()
+    holesNode = self.holesSelector.currentNode()
+    if holesNode == None:
+      return surfaceLocator, None, [], worldMatrix
+    key = (holesNode.GetID(), holesNode.GetMTime())
+    if key != self.holeIndexKey:
+      self.holeNames, holes = fiducialListPoints(holesNode)
+      self.holeIndex = self.logic.surfaceIndex(holes) if len(holes) else None
+      self.holeIndexKey = key
+    return surfaceLocator, self.holeIndex, self.holeNames, worldMatrix
+
+  def getModelToTemplateTransform(self):
+    """Returns the registration transform node, adding it to the scene if needed."""
+    self.followupTransform = self.getTransformNode('ModelToTemplateTransform')
+    return self.followupTransform
+
+  def getTransformNode(self, name):
+    """Returns the linear transform node the module owns under this name, 
+    adding it to the scene if needed."""
+    from iGyneModelToTemplateRegistrationLib.Instrumentation import stageTimer
+    transformNode = nodeRegistry.get(name)
+    if transformNode == None:
+      start = time.time()
+      transformNode = slicer.vtkMRMLLinearTransformNode()
+      transformNode.SetName(name)
+      transformNode.SetScene(slicer.mrmlScene)
+      slicer.mrmlScene.AddNode(transformNode)
+      nodeRegistry.register(name, transformNode)
+      stageTimer.record('node creation', time.time() - start)
+    return transformNode
+
+  def getPointSetNode(self, name, hidden=False):
+    """Returns the markups fiducial node holding a whole landmark list, 
+    adding it to the scene if needed."""
+    from iGyneModelToTemplateRegistrationLib.Instrumentation import stageTimer
+    pointSetNode = nodeRegistry.get(name)
+    if pointSetNode != None:
+      return pointSetNode
+    start = time.time()
+    displayNode = slicer.vtkMRMLMarkupsDisplayNode()
+    self.scene.AddNode(displayNode)
+    pointSetNode = slicer.vtkMRMLMarkupsFiducialNode()
+    pointSetNode.SetName(name)
+    pointSetNode.SetHideFromEditors(hidden)
+    self.scene.AddNode(pointSetNode)
+    pointSetNode.SetAndObserveDisplayNodeID(displayNode.GetID())
+    nodeRegistry.register(name, pointSetNode)
+    stageTimer.record('node creation', time.time() - start)
+    return pointSetNode
+
+  def checkSceneGrowth(self, registrations=50):
+    """Runs repeated registrations on the collected landmarks and reports 
+    the scene node count and the memory of Slicer before and after. Meant 
+    to be called on the module widget from the Python console."""
+    nodesBefore = sceneNodeCounts(self.scene)
+    memoryBefore = residentMemory()
+    for registration in xrange(registrations):
+      self.onRegistrationButtonClicked()
+      slicer.app.processEvents()
+    self.cancelRegistration()
+    nodesAfter = sceneNodeCounts(self.scene)
+    memoryAfter = residentMemory()
+    print "Scene nodes: %d before, %d after %d registrations" % (sum(nodesBefore.values()), sum(nodesAfter.values()), registrations)
+    for className in sorted(set(nodesBefore) | set(nodesAfter)):
+      change = nodesAfter.get(className, 0) - nodesBefore.get(className, 0)
+      if change:
+        print "  %s: %+d" % (className, change)
+    print "Resident memory: %.1f MB before, %.1f MB after" % (memoryBefore / 1048576.0, memoryAfter / 1048576.0)
+    return nodesBefore, nodesAfter
+
+  def readModelFiducialList(self):
+    """Returns the model fiducials in world coordinates as an Nx3 array, or 
+    None when the selected list does not hold one point per landmark."""
+    modelFiducials = self.modelFiducialSelector.currentNode()
+    if modelFiducials == None:
+      return None
     
-    p = numpy.zeros((n,3))
-    for i in xrange(n):
-      f = collection.GetItemAsObject(i)
-      coords = [0,0,0]
-      # Need to change to consider the transform that is applied to the points
-      f.GetFiducialCoordinates(coords)
-      newCoords = numpy.add(numpy.dot(rotationTransform1,coords),shiftTransform1)
-      newfid = slicer.vtkMRMLAnnotationFiducialNode()
-      newfid.SetFiducialCoordinates(newCoords)
-      newfid.SetHideFromEditors(0)
-      newfid.SetName(str(i))
-      self.scene.AddNode(newfid)
-
-    fixedLandmarksListID = self.newModelFiducialAnnotationList.GetID() 
+    # Changing the fiducial coordinates according to the transform
+    names, p = fiducialListPoints(modelFiducials)
+
+    if len(p) != len(self.logic.landmarks): 
+      # output an error and ask user to select a fiducial list with one point per landmark
+      print "The model fiducial list must have %d points, or Reset the collection to use one of %d" % (len(self.logic.landmarks), len(p))
+      return None
+
+    # the whole parent chain of the template, scaling included, in one product
+    return self.logic.modelToWorld(p, self.templateToWorldMatrix())
 
+  def onModelFiducialsChanged(self):
+    """A model fiducial list with other fiducials defines a new set of 
+    landmarks, named after them."""
+    modelFiducials = self.modelFiducialSelector.currentNode()
+    if modelFiducials != None:
+      names, points = fiducialListPoints(modelFiducials)
+      if len(names) >= 3:
+        # unlabeled fiducials are named by their number
+        self.defineLandmarks([name or '%d' % (i+1) for i, name in enumerate(names)])
+    self.resetProvisionalRegistration()
+
+  def resetProvisionalRegistration(self):
+    """Restarts the running sums, e.g. after the model fiducial list changed."""
+    modelLandmarks = None
+    if self.modelFiducialSelector.currentNode() != None and self.templateSelector.currentNode() != None:
+      modelLandmarks = self.readModelFiducialList()
+    self.logic.setModelLandmarks(modelLandmarks)
+    self.updateProvisionalRegistration()
+
+  def updateProvisionalRegistration(self):
+    """Reports, and optionally shows, the registration of the points collected so far."""
+    similarity = self.transformTypeSelector.currentText == 'Similarity'
+    provisional = self.logic.provisionalRegistration(similarity)
+    if provisional is None:
+      return
+    matrix, rms = provisional
+    self.setRegistrationStatus('Provisional (%d points), RMS = %.2f mm' % (self.logic.incrementalRegistration.count, rms))
+    if self.showProvisionalCheckBox.checked:
+      setTransformNodeMatrix(self.getModelToTemplateTransform(), matrix)
+
+  def runCLIRegistration(self, fixedLandmarksListID, movingLandmarksListID):
+    """Fallback to the fiducialregistration CLI module. The CLI runs in a 
+    separate process, so the RMS is only available once it has completed."""
     self.OutputMessage = ""
     parameters = {}
     parameters["fixedLandmarks"] = fixedLandmarksListID 
     parameters["movingLandmarks"] = movingLandmarksListID
    
     parameters["saveTransform"] = self.followupTransform
-    parameters["transformType"] = "Rigid"
+    parameters["transformType"] = self.transformTypeSelector.currentText
     parameters["rms"] = self.RMS
     parameters["outputMessage"] = self.OutputMessage
     
     fidreg = slicer.modules.fiducialregistration
     self.__cliNode = None
     self.__cliNode = slicer.cli.run(fidreg, self.__cliNode, parameters)
-    print "RMS is", self.RMS
-    #self.__cliObserverTag = self.__cliNode.AddObserver('ModifiedEvent', self.processRegistrationCompletion)
-    #self.__registrationStatus.setText('Wait ...')
-    #self.firstRegButton.setEnabled(0)
+    self.__cliObserverTag = self.__cliNode.AddObserver('ModifiedEvent', self.processRegistrationCompletion)
+
+  def processRegistrationCompletion(self, cliNode, event):
+    """Observes the CLI node and finishes the registration once it is done."""
+    status = cliNode.GetStatusString()
+    if status == 'Completed':
+      self.removeCLIObserver()
+      self.RMS = float(cliNode.GetParameterAsString('rms'))
+      self.residuals = None
+      self.logic.setResult(None, self.RMS)
+      self.finishRegistration()
+    elif status in ('Cancelled', 'Completed with errors'):
+      self.removeCLIObserver()
+      self.setRegistrationStatus('Registration ' + status.lower())
 
+  def removeCLIObserver(self):
+    if self.__cliObserverTag is not None:
+      self.__cliNode.RemoveObserver(self.__cliObserverTag)
+      self.__cliObserverTag = None
+
+  def onRegistrationTimer(self):
+    """Hands the result of the background job back to the main thread."""
+    from iGyneModelToTemplateRegistrationLib.Instrumentation import stageTimer
+    job = self.registrationJob
+    if job is None:
+      self.registrationTimer.stop()
+      return
+    if job.is_alive():
+      self.registrationProgressBar.value = job.progress
+      return
+    self.registrationTimer.stop()
+    self.registrationJob = None
+    if job.error is not None:
+      self.setRegistrationStatus('Registration failed: %s' % job.error)
+      return
+    matrix, self.RMS, self.residuals = job.result
+    self.logic.setResult(matrix, self.RMS, self.residuals, job.landmarkRMS)
+    setTransformNodeMatrix(self.getModelToTemplateTransform(), matrix)
+    stageTimer.record('solve', job.elapsed)
+    self.finishRegistration()
+    if job.surfaceResult is not None:
+      iterations, timePerIteration, surfaceRMS = job.surfaceResult
+      print "ICP: %d iterations, %.1f ms per iteration, surface RMS %.2f mm" % (iterations, 1000 * timePerIteration, surfaceRMS)
+      self.setRegistrationStatus('Done, RMS = %.2f mm, surface RMS = %.2f mm (%d ICP iterations)' % (self.RMS, surfaceRMS, iterations))
+    elif job.surfaceNote is not None:
+      print "ICP:", job.surfaceNote
+      self.setRegistrationStatus('Done, RMS = %.2f mm, %s' % (self.RMS, job.surfaceNote))
+
+  def finishRegistration(self):
+    print "RMS is", self.RMS
+    print "Residuals are", self.residuals
+    self.setRegistrationStatus('Done, RMS = %.2f mm' % self.RMS)
+    self.diagnoseLandmarks()
+    if self.targetErrorCheckBox.checked:
+      self.showTargetRegistrationError()
     stylusNode = self.stylusTrackerSelector.currentNode() 
-    stylusNode.SetAndObserveTransformNodeID(self.followupTransform.GetID())
+    if self.referenceAttachment.referenceNode != None:
+      # attached in coalesced mode, the stylus follows the composed transform
+      stylusNode.SetAndObserveTransformNodeID(self.referenceAttachment.composedNode.GetID())
+    else:
+      stylusNode.SetAndObserveTransformNodeID(self.followupTransform.GetID())
+
+  def diagnoseLandmarks(self):
+    """Flags mis-collected landmarks, or an inconsistent registration, from 
+    the leave-one-out and minimal subset solves."""
+    from iGyneModelToTemplateRegistrationLib.Instrumentation import stageTimer
+    similarity = self.transformTypeSelector.currentText == 'Similarity'
+    start = time.time()
+    looErrors, influence, consistency, suspects, consistent = self.logic.diagnose(similarity)
+    stageTimer.record('diagnostics', time.time() - start)
+    print "%-12s %16s %14s %12s" % ("landmark", "left out error", "influence", "consistency")
+    for i, button in enumerate(self.landmarkButtons):
+      print "%-12s %13.2f mm %11.2f mm %11.0f%%" % (button.text, looErrors[i], influence[i], 100 * consistency[i])
+      button.toolTip = "Left out error %.2f mm, influence %.2f mm, consistent in %.0f%% of the 3-point fits" % (looErrors[i], influence[i], 100 * consistency[i])
+    recollect = ', '.join('%s (%.1f mm off when left out)' % (self.landmarkButtons[i].text, looErrors[i]) for i in suspects)
+    if not consistent:
+      text = 'Registration inconsistent, landmarks %.1f mm off when left out (median): check the model fiducials and their order' % numpy.median(looErrors)
+      self.diagnosticsLabel.text = text + ('; re-collect ' + recollect if suspects else '')
+    elif suspects:
+      self.diagnosticsLabel.text = 'Re-collect ' + recollect
+    else:
+      self.diagnosticsLabel.text = 'All landmarks are consistent'
+
+  def showTargetRegistrationError(self):
+    """Predicts the target registration error at every template vertex and 
+    needle hole from the landmark configuration, and shows it on the 
+    template as the 'TRE' point scalars."""
+    from iGyneModelToTemplateRegistrationLib.Instrumentation import stageTimer
+    templateNode = self.templateSelector.currentNode()
+    polyData = templateNode.GetPolyData() if templateNode != None else None
+    if polyData == None or polyData.GetNumberOfPoints() == 0:
+      return
+    from vtk.util import numpy_support
+    similarity = self.transformTypeSelector.currentText == 'Similarity'
+    start = time.time()
+    worldMatrix = self.templateToWorldMatrix()
+    # the prediction only depends on distances, so the vertices are moved 
+    # to the world frame of the landmarks instead of the other way round
+    vertices = numpy_support.vtk_to_numpy(polyData.GetPoints().GetData())
+    errors, localizationError = self.logic.targetRegistrationError(self.logic.modelToWorld(vertices, worldMatrix), self.localizationErrorSpinBox.value, similarity)
+    holesNode = self.holesSelector.currentNode()
+    holeErrors = None
+    if holesNode != None:
+      holeNames, holes = fiducialListPoints(holesNode)
+      if len(holes) > 0:
+        holeErrors, localizationError = self.logic.targetRegistrationError(self.logic.modelToWorld(holes, worldMatrix), localizationError)
+    stageTimer.record('tre map', time.time() - start)
+
+    array = numpy_support.numpy_to_vtk(errors, deep=1)
+    array.SetName('TRE')
+    polyData.GetPointData().AddArray(array)
+    polyData.Modified()
+    displayNode = templateNode.GetDisplayNode()
+    if displayNode != None:
+      displayNode.SetActiveScalarName('TRE')
+      displayNode.SetAndObserveColorNodeID('vtkMRMLColorTableNodeRainbow')
+      displayNode.SetScalarRange(errors.min(), errors.max())
+      displayNode.SetScalarVisibility(1)
+
+    text = 'FLE %.2f mm, template %.2f to %.2f mm' % (localizationError, errors.min(), errors.max())
+    if holeErrors is not None:
+      worst = holeErrors.argmax()
+      text += ', holes up to %.2f mm (%s)' % (holeErrors[worst], holeNames[worst])
+      for name, error in zip(holeNames, holeErrors):
+        print "%-12s %6.2f mm" % (name, error)
+    self.targetErrorLabel.text = text
+
+  def cancelRegistration(self):
+    """Drops a running registration, e.g. because its inputs have changed."""
+    if self.registrationJob is not None:
+      self.registrationJob.cancel()
+      self.registrationJob = None
+      self.registrationTimer.stop()
+      self.setRegistrationStatus('Cancelled')
+    if self.__cliObserverTag is not None:
+      self.__cliNode.Cancel()
+      self.removeCLIObserver()
+      self.setRegistrationStatus('Cancelled')
+
+  def setRegistrationStatus(self, text, progress=None):
+    self.registrationStatusLabel.text = text
+    self.registrationProgressBar.visible = progress is not None
+    if progress is not None:
+      self.registrationProgressBar.value = progress
 
 
 
   def onAttachButtonClicked(self):
+    from iGyneModelToTemplateRegistrationLib.Instrumentation import stageTimer
     print "Hello Attachment :) "
+    with stageTimer.measure('attach'):
+      self.attach()
+
+  def attach(self):
+    """Moves the model, the image and the stylus with the reference tracker."""
     childNode = self.childNodeSelector.currentNode()
+    referenceNode = self.referenceTrackerSelector.currentNode()
+    stylusNode = self.stylusTrackerSelector.currentNode()
+    self.getModelToTemplateTransform()
+    self.referenceAttachment.detach()
+    if self.coalesceCheckBox.checked:
+      referenceProxy = self.getTransformNode('ReferenceProxyTransform')
+      composedTransform = self.getTransformNode('ReferenceModelToTemplateTransform')
+      self.followupTransform.SetAndObserveTransformNodeID(None)
+      # move the model and the image
+      childNode.SetAndObserveTransformNodeID(referenceProxy.GetID())
+      # move the Stylus
+      stylusNode.SetAndObserveTransformNodeID(composedTransform.GetID())
+      self.referenceAttachment.setMaximumRate(self.maximumRateSpinBox.value)
+      self.referenceAttachment.attach(referenceNode, self.followupTransform, referenceProxy, composedTransform)
+      return
     # move the model and the image
-    childNode.SetAndObserveTransformNodeID(self.referenceTrackerSelector.currentNode().GetID())
+    childNode.SetAndObserveTransformNodeID(referenceNode.GetID())
     # move the Stylus
-    #stylusNode = self.stylusTrackerSelector.currentNode()
-    self.followupTransform.SetAndObserveTransformNodeID(self.referenceTrackerSelector.currentNode().GetID())
+    stylusNode.SetAndObserveTransformNodeID(self.followupTransform.GetID())
+    self.followupTransform.SetAndObserveTransformNodeID(referenceNode.GetID())
+
+  def updateAttachmentStatus(self):
+    attachment = self.referenceAttachment
+    self.attachmentStatusLabel.text = '%d received, %d applied' % (attachment.updatesReceived, attachment.updatesApplied)
+
+  def onLiveDistanceToggled(self, checked):
+    self.liveDistance.stop()
+    if not checked:
+      self.printLiveDistanceLatency()
+      return
+    stylusNode = self.stylusTrackerSelector.currentNode()
+    if stylusNode == None or self.templateSelector.currentNode() == None:
+      self.liveDistanceButton.checked = False
+      return
+    self.liveDistance.start(stylusNode, self.getLiveDistanceIndices)
+
+  def stopLiveDistance(self):
+    self.liveDistanceButton.checked = False
+
+  def updateLiveDistance(self):
+    monitor = self.liveDistance
+    if monitor.surfaceDistance is None:
+      self.surfaceDistanceLabel.text = 'no template surface'
+    else:
+      self.surfaceDistanceLabel.text = '%.1f mm' % monitor.surfaceDistance
+    if monitor.holeDistance is None:
+      self.holeDistanceLabel.text = ''
+    else:
+      self.holeDistanceLabel.text = '%s, %.1f mm' % (monitor.holeName, monitor.holeDistance)
+    p50, p95, p99 = monitor.latencyPercentiles()
+    self.latencyLabel.text = 'p50 %.2f, p95 %.2f, p99 %.2f ms at %.0f Hz' % (p50, p95, p99, monitor.updateRate())
+
+  def trackerNodes(self):
+    """The transform nodes of the recorded streams, by stream name."""
+    nodes = {}
+    if self.stylusTrackerSelector.currentNode() != None:
+      nodes['Stylus'] = self.stylusTrackerSelector.currentNode()
+    if self.referenceTrackerSelector.currentNode() != None:
+      nodes['Reference'] = self.referenceTrackerSelector.currentNode()
+    return nodes
+
+  def onRecordButtonToggled(self, checked):
+    if not checked:
+      if self.trackerRecorder.writer is not None:
+        self.trackerRecorder.stop()
+        self.recordingStatusLabel.text = '%d updates recorded' % self.trackerRecorder.count
+      self.recordButton.text = "Record Trackers"
+      return
+    nodes = self.trackerNodes()
+    if len(nodes) == 0 or self.trackerReplay.records is not None:
+      self.recordButton.checked = False
+      return
+    self.trackerRecorder.start(self.recordingPathEdit.text, sorted(nodes.items()))
+    self.recordButton.text = "Stop Recording"
+    self.recordingStatusLabel.text = 'Recording %s' % ', '.join(sorted(nodes.keys()))
+
+  def onReplayButtonToggled(self, checked):
+    if not checked:
+      self.trackerReplay.stop()
+      self.stylusSampler.clock = time.time
+      self.replayButton.text = "Replay Trackers"
+      return
+    if self.trackerRecorder.writer is not None or not os.path.exists(self.recordingPathEdit.text):
+      self.replayButton.checked = False
+      return
+    speedText = self.replaySpeedSelector.currentText
+    speed = 0 if speedText == 'Max' else float(speedText[:-1])
+    self.stylusSampler.clear()
+    # the stylus samples are stamped with the recorded time
+    self.stylusSampler.clock = self.trackerReplay.clock
+    self.trackerReplay.start(self.recordingPathEdit.text, self.trackerNodes(), speed)
+    if self.trackerReplay.records is None:
+      # an empty recording finishes at once
+      return
+    self.replayButton.text = "Stop Replay"
+    self.recordingStatusLabel.text = 'Replaying %d updates at %s' % (len(self.trackerReplay.records), speedText)
+
+  def onReplayFinished(self):
+    replay = self.trackerReplay
+    self.recordingStatusLabel.text = '%d updates replayed in %.1f s' % (replay.next, time.time() - replay.startTime)
+    self.replayButton.checked = False
+
+  def onSaveSessionButtonClicked(self):
+    if self.logic.fixedLandmarks is None and self.logic.modelLandmarks is None:
+      self.recordingStatusLabel.text = 'Select the model fiducials first'
+      return
+    similarity = self.transformTypeSelector.currentText == 'Similarity'
+    surfaceIndex = None
+    if self.surfaceRefinementCheckBox.checked and self.templateSelector.currentNode() != None:
+      surfaceIndex = self.getTemplateSurfaceIndex()
+    path = os.path.splitext(self.recordingPathEdit.text)[0] + '.npz'
+    self.logic.saveSession(path, similarity, surfaceIndex)
+    self.recordingStatusLabel.text = 'Session saved to %s' % path
+
+  def printLiveDistanceLatency(self):
+    monitor = self.liveDistance
+    if monitor.count == 0:
+      return
+    print "Live distance: %d updates at %.0f Hz" % (monitor.count, monitor.updateRate())
+    print "Latency p50 %.3f ms, p95 %.3f ms, p99 %.3f ms" % tuple(monitor.latencyPercentiles())
+
+
+#
+# Reference attachment
+#
+
+class ReferenceAttachment:
+  """Moves the attached nodes with the reference tracker at display rate. 
+  Parenting them under the reference transform propagates every tracker 
+  update through the hierarchy and re-renders each time. Here reference 
+  and registration updates only mark the cached reference * registration 
+  matrix dirty, and a timer pushes at most one update per interval into 
+  two proxy transforms: one for the reference alone, one composed with 
+  the registration for the stylus."""
+  def __init__(self, maximumRate=60):
+    self.referenceNode = None
+    self.registrationNode = None
+    self.referenceProxyNode = None
+    self.composedNode = None
+    self.observations = []
+    self.referenceMatrix = vtk.vtkMatrix4x4()
+    self.registrationMatrix = vtk.vtkMatrix4x4()
+    self.composedMatrix = vtk.vtkMatrix4x4()
+    self.dirty = False
+    self.registrationDirty = False
+    self.updatesReceived = 0
+    self.updatesApplied = 0
+    self.pushCallback = None
+    self.timer = qt.QTimer()
+    self.timer.connect('timeout()', self.push)
+    self.setMaximumRate(maximumRate)
+
+  def setMaximumRate(self, rate):
+    self.timer.setInterval(int(1000.0 / max(rate, 1)))
+
+  def attach(self, referenceNode, registrationNode, referenceProxyNode, composedNode):
+    self.detach()
+    self.referenceNode = referenceNode
+    self.registrationNode = registrationNode
+    self.referenceProxyNode = referenceProxyNode
+    self.composedNode = composedNode
+    self.updatesReceived = 0
+    self.updatesApplied = 0
+    event = slicer.vtkMRMLTransformNode.TransformModifiedEvent
+    self.observations.append((referenceNode, referenceNode.AddObserver(event, self.onReferenceModified)))
+    self.observations.append((registrationNode, registrationNode.AddObserver(event, self.onRegistrationModified)))
+    self.dirty = True
+    self.registrationDirty = True
+    self.push()
+
+  def detach(self):
+    for node, tag in self.observations:
+      node.RemoveObserver(tag)
+    self.observations = []
+    self.timer.stop()
+    self.referenceNode = None
+    self.registrationNode = None
+
+  def onReferenceModified(self, node, event):
+    self.updatesReceived += 1
+    self.markDirty()
+
+  def onRegistrationModified(self, node, event):
+    self.updatesReceived += 1
+    self.registrationDirty = True
+    self.markDirty()
+
+  def markDirty(self):
+    self.dirty = True
+    if not self.timer.isActive():
+      self.timer.start()
+
+  def push(self):
+    """Applies the latest reference and registration, once per interval."""
+    from iGyneModelToTemplateRegistrationLib.Instrumentation import stageTimer
+    if not self.dirty or self.referenceNode == None:
+      # nothing came in during the last interval, sleep until the next update
+      self.timer.stop()
+      return
+    start = time.time()
+    self.dirty = False
+    if self.registrationDirty:
+      self.registrationMatrix.DeepCopy(self.registrationNode.GetMatrixTransformToParent())
+      self.registrationDirty = False
+    self.referenceNode.GetMatrixTransformToWorld(self.referenceMatrix)
+    vtk.vtkMatrix4x4.Multiply4x4(self.referenceMatrix, self.registrationMatrix, self.composedMatrix)
+    self.referenceProxyNode.GetMatrixTransformToParent().DeepCopy(self.referenceMatrix)
+    self.composedNode.GetMatrixTransformToParent().DeepCopy(self.composedMatrix)
+    self.updatesApplied += 1
+    stageTimer.record('attach push', time.time() - start)
+    if self.pushCallback is not None:
+      self.pushCallback()
+
+#
+# Scene helpers
+#
+
+class NodeRegistry:
+  """The nodes the module owns, keyed by node ID, with a map from their role 
+  (e.g. 'ModelToTemplateTransform') to the ID. The role is also stored as a 
+  node attribute, so a saved scene is picked up again by one scan after 
+  import. Scene observers keep the registry current, so lookups never scan 
+  the scene and do not depend on node names."""
+  roleAttribute = 'iGyneModelToTemplateRegistration.Role'
+
+  def __init__(self):
+    self.scene = None
+    self.observerTags = []
+    self.nodes = {}
+    self.roles = {}
+
+  def setScene(self, scene):
+    if scene is self.scene:
+      return
+    for tag in self.observerTags:
+      self.scene.RemoveObserver(tag)
+    self.observerTags = []
+    self.scene = scene
+    self.rebuild()
+    if scene != None:
+      self.observerTags.append(scene.AddObserver(scene.NodeAddedEvent, self.onNodeAdded))
+      self.observerTags.append(scene.AddObserver(scene.NodeRemovedEvent, self.onNodeRemoved))
+      self.observerTags.append(scene.AddObserver(scene.EndCloseEvent, self.onEndClose))
+      self.observerTags.append(scene.AddObserver(scene.EndImportEvent, self.onEndImport))
+
+  def rebuild(self):
+    """Finds the owned nodes by their role attribute, once."""
+    self.nodes = {}
+    self.roles = {}
+    if self.scene == None:
+      return
+    for i in xrange(self.scene.GetNumberOfNodes()):
+      node = self.scene.GetNthNode(i)
+      role = node.GetAttribute(self.roleAttribute)
+      if role:
+        self.add(role, node)
+
+  def register(self, role, node):
+    node.SetAttribute(self.roleAttribute, role)
+    self.add(role, node)
+
+  def add(self, role, node):
+    self.nodes[node.GetID()] = node
+    self.roles[role] = node.GetID()
+
+  def get(self, role):
+    """The node of the given role, or None."""
+    from iGyneModelToTemplateRegistrationLib.Instrumentation import stageTimer
+    start = time.time()
+    nodeID = self.roles.get(role)
+    node = self.nodes.get(nodeID) if nodeID is not None else None
+    stageTimer.record('scene lookup', time.time() - start)
+    return node
+
+  def onNodeAdded(self, scene, event, node=None):
+    if node is None or scene.IsImporting():
+      # a whole scene is coming in, onEndImport scans it once
+      return
+    role = node.GetAttribute(self.roleAttribute)
+    if role and node.GetID() not in self.nodes:
+      self.add(role, node)
+  if hasattr(vtk, 'VTK_OBJECT'):
+    onNodeAdded.CallDataType = vtk.VTK_OBJECT
+
+  def onNodeRemoved(self, scene, event, node=None):
+    if node is not None:
+      removedIDs = [node.GetID()]
+    else:
+      # no call data from older VTK wrappers, check the few owned nodes
+      removedIDs = [nodeID for nodeID, owned in self.nodes.items() if not scene.IsNodePresent(owned)]
+    for nodeID in removedIDs:
+      if self.nodes.pop(nodeID, None) is not None:
+        for role, roleID in self.roles.items():
+          if roleID == nodeID:
+            del self.roles[role]
+  if hasattr(vtk, 'VTK_OBJECT'):
+    onNodeRemoved.CallDataType = vtk.VTK_OBJECT
+
+  def onEndClose(self, scene, event):
+    self.nodes = {}
+    self.roles = {}
+
+  def onEndImport(self, scene, event):
+    self.rebuild()
+
+nodeRegistry = NodeRegistry()
+
+def fiducialListPoints(fiducialListNode):
+  """Names and Nx3 coordinates of the fiducials of an annotation hierarchy 
+  or of a markups fiducial node."""
+  names = []
+  coords = [0,0,0]
+  if fiducialListNode.IsA('vtkMRMLMarkupsFiducialNode'):
+    n = fiducialListNode.GetNumberOfFiducials()
+    points = numpy.zeros((n,3))
+    for i in xrange(n):
+      fiducialListNode.GetNthFiducialPosition(i, coords)
+      points[i] = coords
+      names.append(fiducialListNode.GetNthFiducialLabel(i))
+    return names, points
+  # slicer4 style hierarchy nodes
+  collection = vtk.vtkCollection()
+  fiducialListNode.GetChildrenDisplayableNodes(collection)
+  n = collection.GetNumberOfItems()
+  points = numpy.zeros((n,3))
+  for i in xrange(n):
+    fiducial = collection.GetItemAsObject(i)
+    fiducial.GetFiducialCoordinates(coords)
+    points[i] = coords
+    names.append(fiducial.GetName())
+  return names, points
+
+def setPointSetPoint(pointSetNode, index, point, label=None):
+  """Sets one point of a markups fiducial node, appending it if needed."""
+  if index < pointSetNode.GetNumberOfFiducials():
+    pointSetNode.SetNthFiducialPosition(index, point[0], point[1], point[2])
+  else:
+    index = pointSetNode.AddFiducial(point[0], point[1], point[2])
+  if label is not None:
+    pointSetNode.SetNthFiducialLabel(index, label)
+
+def setPointSetCoordinates(pointSetNode, points, labels=None):
+  """Updates all the points of a markups fiducial node in place, with a 
+  single Modified event."""
+  wasModifying = pointSetNode.StartModify()
+  while pointSetNode.GetNumberOfFiducials() > len(points):
+    pointSetNode.RemoveMarkup(pointSetNode.GetNumberOfFiducials() - 1)
+  for i in xrange(len(points)):
+    setPointSetPoint(pointSetNode, i, points[i], labels[i] if labels is not None else None)
+  pointSetNode.EndModify(wasModifying)
+
+def sceneNodeCounts(scene):
+  """Number of nodes in the scene per node class."""
+  counts = {}
+  for i in xrange(scene.GetNumberOfNodes()):
+    className = scene.GetNthNode(i).GetClassName()
+    counts[className] = counts.get(className, 0) + 1
+  return counts
+
+def residentMemory():
+  """Resident memory of the process in bytes, the peak where the current 
+  value is not available."""
+  try:
+    import os
+    pages = int(open('/proc/self/statm').read().split()[1])
+    return pages * os.sysconf('SC_PAGE_SIZE')
+  except (IOError, OSError, ValueError):
+    pass
+  try:
+    import resource
+  except ImportError:
+    return 0
+  import sys
+  peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+  # kilobytes on Linux, bytes on Mac
+  return peak if sys.platform == 'darwin' else peak * 1024
+
+#
+# Stylus sampling
+#
+
+class StylusSampler:
+  """Records every update of the stylus transform node into a ring buffer 
+  of (time, x, y, z) rows, so a landmark is a robust average over the last 
+  samples instead of a single tracker frame. The buffer grows when it 
+  would overwrite a sample younger than the retention time, the longest 
+  window it is asked for, whatever the tracker rate. With a dwell 
+  callback set, the callback fires once the tip has stayed still for the 
+  dwell time, by the dwellCenter rule of the registration package. Between startRecording and stopRecording 
+  the tip positions are also kept in a growing buffer of up to 
+  maximumRecording rows, for the stylus sweep."""
+  def __init__(self, capacity=2048, retention=5.0, maximumRecording=1048576):
+    self.samples = numpy.zeros((capacity, 4))
+    self.capacity = capacity
+    self.retention = retention
+    self.count = 0
+    self.next = 0
+    self.transformNode = None
+    self.observerTag = None
+    self.dwellCallback = None
+    self.dwellTime = 1.0
+    self.dwellTolerance = 0.5
+    self.rearmDistance = 5.0
+    self.lastCapture = None
+    # when the tip left the last captured landmark
+    self.rearmTime = None
+    self.recording = None
+    self.recordingCount = 0
+    self.maximumRecording = maximumRecording
+    self.droppedSamples = 0
+    # replaced by the replay clock while a recorded session is replayed
+    self.clock = time.time
+
+  def setTransformNode(self, transformNode):
+    if self.observerTag is not None:
+      self.transformNode.RemoveObserver(self.observerTag)
+      self.observerTag = None
+    self.transformNode = transformNode
+    self.clear()
+    if transformNode != None:
+      self.observerTag = transformNode.AddObserver(slicer.vtkMRMLTransformNode.TransformModifiedEvent, self.onTransformModified)
+
+  def setDwellCapture(self, callback, dwellTime=1.0, dwellTolerance=0.5):
+    self.dwellCallback = callback
+    self.dwellTime = dwellTime
+    if callback is not None:
+      self.retention = max(self.retention, dwellTime)
+    self.dwellTolerance = dwellTolerance
+    self.lastCapture = None
+    self.rearmTime = None
+
+  def clear(self):
+    self.count = 0
+    self.next = 0
+    self.lastCapture = None
+    self.rearmTime = None
+
+  def onTransformModified(self, transformNode, event):
+    m = transformNode.GetMatrixTransformToParent()
+    self.addSample(self.clock(), m.GetElement(0,3), m.GetElement(1,3), m.GetElement(2,3))
+
+  def addSample(self, timestamp, x, y, z):
+    if self.count == self.capacity and self.samples[self.next, 0] > timestamp - self.retention:
+      self.grow()
+    row = self.samples[self.next]
+    row[0] = timestamp
+    row[1] = x
+    row[2] = y
+    row[3] = z
+    self.next = (self.next + 1) % self.capacity
+    self.count = min(self.count + 1, self.capacity)
+    if self.recording is not None:
+      self.recordSample(x, y, z)
+    if self.dwellCallback is not None:
+      self.checkDwell(timestamp)
+
+  def grow(self):
+    """Doubles the full ring buffer, oldest sample first."""
+    grown = numpy.zeros((2 * self.capacity, 4))
+    grown[:self.capacity] = numpy.roll(self.samples, -self.next, axis=0)
+    self.samples = grown
+    self.next = self.capacity
+    self.capacity *= 2
+
+  def oldestTime(self):
+    return self.samples[self.next if self.count == self.capacity else 0, 0]
+
+  def startRecording(self, initialSize=4096):
+    self.recording = numpy.zeros((min(initialSize, self.maximumRecording), 3))
+    self.recordingCount = 0
+    self.droppedSamples = 0
+
+  def stopRecording(self):
+    """Returns the tip positions recorded since startRecording and the 
+    number of samples dropped once maximumRecording was reached."""
+    positions = self.recording[:self.recordingCount].copy()
+    self.recording = None
+    self.recordingCount = 0
+    return positions, self.droppedSamples
+
+  def recordSample(self, x, y, z):
+    if self.recordingCount == len(self.recording):
+      if self.recordingCount >= self.maximumRecording:
+        self.droppedSamples += 1
+        return
+      # geometric growth keeps appending amortized O(1)
+      grown = numpy.zeros((min(2 * self.recordingCount, self.maximumRecording), 3))
+      grown[:self.recordingCount] = self.recording
+      self.recording = grown
+    row = self.recording[self.recordingCount]
+    row[0] = x
+    row[1] = y
+    row[2] = z
+    self.recordingCount += 1
+
+  def window(self, duration, now=None):
+    """Returns the tip positions recorded within the last duration seconds."""
+    if self.count == 0:
+      return self.samples[:0, 1:]
+    samples = self.samples[:self.count]
+    if now is None:
+      now = self.samples[self.next - 1, 0]
+    return samples[samples[:,0] >= now - duration, 1:]
+
+  def tipPosition(self, duration=0.25, method='median', trim=0.2):
+    """Robust average of the recent tip positions, or None without samples. 
+    The median is taken per axis, the trimmed mean drops the given fraction 
+    of samples at both ends of each axis."""
+    positions = self.window(duration)
+    if len(positions) == 0:
+      return None
+    if method == 'median':
+      return numpy.median(positions, axis=0)
+    cut = int(trim * len(positions))
+    positions = numpy.sort(positions, axis=0)
+    return positions[cut:len(positions) - cut].mean(axis=0)
+
+  def checkDwell(self, now):
+    positions = self.window(self.dwellTime, now)
+    if self.lastCapture is not None:
+      # wait until the tip has been moved away from the previous landmark
+      latest = numpy.median(self.window(0.1, now), axis=0)
+      if numpy.sqrt(((latest - self.lastCapture)**2).sum()) > self.rearmDistance:
+        self.lastCapture = None
+        self.rearmTime = now
+      return
+    if self.oldestTime() > now - self.dwellTime or (self.rearmTime is not None and self.rearmTime > now - self.dwellTime):
+      # the samples do not reach back a whole dwell time yet, or reach
+      # back to the previous landmark
+      return
+    # the rule of the batch registration, so it finds the same landmarks
+    from iGyneModelToTemplateRegistrationLib.TrackerRecording import dwellCenter
+    center = dwellCenter(positions, self.dwellTolerance)
+    if center is not None:
+      self.lastCapture = center
+      self.dwellCallback()
+
+#
+# Live distance
+#
+
+class LiveDistanceMonitor:
+  """Answers, on every update of the stylus transform node, the distance 
+  of the stylus tip to the closest point on the template surface and to 
+  the nearest needle hole. The surface cell locator and the hole index 
+  come from an index provider, which is expected to cache them in template 
+  model coordinates, so an update only costs moving the tip into the model 
+  and two queries. 
+  The time each update takes is kept in a ring buffer for latency 
+  percentiles, and the display callback is throttled to displayInterval."""
+  def __init__(self, capacity=4096, displayInterval=0.1):
+    self.samples = numpy.zeros((capacity, 2))
+    self.capacity = capacity
+    self.count = 0
+    self.next = 0
+    self.displayInterval = displayInterval
+    self.displayCallback = None
+    self.lastDisplay = 0
+    self.transformNode = None
+    self.observerTag = None
+    self.indexProvider = None
+    self.tipMatrix = vtk.vtkMatrix4x4()
+    self.clearResult()
+
+  def clearResult(self):
+    self.tip = None
+    self.surfaceDistance = None
+    self.closestPoint = None
+    self.holeName = None
+    self.holeDistance = None
+
+  def start(self, transformNode, indexProvider):
+    self.stop()
+    self.count = 0
+    self.next = 0
+    self.clearResult()
+    self.indexProvider = indexProvider
+    # build the indices now rather than on the first tracker update
+    indexProvider()
+    self.transformNode = transformNode
+    self.observerTag = transformNode.AddObserver(slicer.vtkMRMLTransformNode.TransformModifiedEvent, self.onTransformModified)
+    self.onTransformModified(transformNode, None)
+
+  def stop(self):
+    if self.observerTag is not None:
+      self.transformNode.RemoveObserver(self.observerTag)
+      self.observerTag = None
+    self.transformNode = None
+
+  def onTransformModified(self, transformNode, event):
+    from iGyneModelToTemplateRegistrationLib.Instrumentation import stageTimer
+    start = time.time()
+    transformNode.GetMatrixTransformToWorld(self.tipMatrix)
+    m = self.tipMatrix
+    tip = numpy.array([m.GetElement(0,3), m.GetElement(1,3), m.GetElement(2,3)])
+    surfaceLocator, holeIndex, holeNames, modelToWorld = self.indexProvider()
+    self.query(tip, surfaceLocator, holeIndex, holeNames, modelToWorld)
+    now = time.time()
+    self.addSample(now, now - start)
+    stageTimer.record('live distance', now - start)
+    if self.displayCallback is not None and now - self.lastDisplay >= self.displayInterval:
+      self.lastDisplay = now
+      self.displayCallback()
+
+  def query(self, tip, surfaceLocator, holeIndex=None, holeNames=(), modelToWorld=None):
+    """Looks up the world tip in the model coordinates of the locator and 
+    the index, and measures the distances to the closest points in world 
+    coordinates, exact for rigid and isotropically scaled transforms."""
+    self.clearResult()
+    self.tip = tip
+    if modelToWorld is None:
+      modelToWorld = numpy.identity(4)
+    worldToModel = numpy.linalg.inv(modelToWorld)
+    modelTip = numpy.dot(worldToModel[:3,:3], tip) + worldToModel[:3,3]
+    if surfaceLocator is not None:
+      closestPoint = [0.0, 0.0, 0.0]
+      surfaceLocator.FindClosestPoint(modelTip, closestPoint, vtk.mutable(0), vtk.mutable(0), vtk.mutable(0.0))
+      self.closestPoint = numpy.dot(modelToWorld[:3,:3], closestPoint) + modelToWorld[:3,3]
+      self.surfaceDistance = numpy.sqrt(((self.closestPoint - tip)**2).sum())
+    if holeIndex is not None:
+      index, distance = holeIndex.closestPoints(modelTip[numpy.newaxis])
+      hole = numpy.dot(modelToWorld[:3,:3], holeIndex.points[index[0]]) + modelToWorld[:3,3]
+      self.holeName = holeNames[index[0]]
+      self.holeDistance = numpy.sqrt(((hole - tip)**2).sum())
+
+  def addSample(self, timestamp, latency):
+    row = self.samples[self.next]
+    row[0] = timestamp
+    row[1] = latency
+    self.next = (self.next + 1) % self.capacity
+    self.count = min(self.count + 1, self.capacity)
+
+  def latencyPercentiles(self, percentiles=(50, 95, 99)):
+    """Update latencies in milliseconds at the given percentiles."""
+    if self.count == 0:
+      return [0.0] * len(percentiles)
+    return list(1000 * numpy.percentile(self.samples[:self.count, 1], percentiles))
+
+  def updateRate(self):
+    """Mean number of updates per second over the recorded samples."""
+    if self.count < 2:
+      return 0.0
+    timestamps = self.samples[:self.count, 0]
+    span = timestamps.max() - timestamps.min()
+    return (self.count - 1) / span if span > 0 else 0.0
+
+#
+# Tracker recording
+#
+
+class TrackerRecorder:
+  """Appends every update of the observed transform nodes, as a timestamped 
+  4x4 matrix to parent, to a tracker recording. The file format, its writer 
+  and reader are in the TrackerRecording module of the registration 
+  package, so recorded sessions can also be registered without Slicer."""
+  def __init__(self):
+    self.writer = None
+    self.observers = []
+    self.count = 0
+
+  def start(self, path, namedNodes):
+    """Starts recording the (name, transform node) pairs to path."""
+    from iGyneModelToTemplateRegistrationLib.TrackerRecording import TrackerRecordingWriter
+    self.stop()
+    self.writer = TrackerRecordingWriter(path, [name for name, node in namedNodes])
+    self.count = 0
+    for stream, (name, node) in enumerate(namedNodes):
+      tag = node.AddObserver(slicer.vtkMRMLTransformNode.TransformModifiedEvent, lambda caller, event, stream=stream: self.record(stream, caller))
+      self.observers.append((node, tag))
+
+  def stop(self):
+    for node, tag in self.observers:
+      node.RemoveObserver(tag)
+    self.observers = []
+    if self.writer is None:
+      return
+    self.writer.close()
+    self.count = self.writer.count
+    self.writer = None
+
+  def record(self, stream, transformNode):
+    self.writer.append(stream, time.time(), arrayFromVTKMatrix(transformNode.GetMatrixTransformToParent()))
+
+class TrackerReplay:
+  """Drives transform nodes, matched by stream name, from a tracker 
+  recording. At a speed of 1 the recorded timing is kept, at N the session 
+  plays N times faster, and at 0 the records are applied in batches as fast 
+  as the event loop allows. Every record is applied on its own, so node 
+  observers see the same sequence of updates as during the recording, and 
+  clock() gives the recorded time of the current update."""
+  def __init__(self, batchSize=200, interval=5):
+    self.batchSize = batchSize
+    self.interval = interval
+    self.records = None
+    self.nodes = []
+    self.next = 0
+    self.speed = 1.0
+    self.currentTime = 0.0
+    self.startTime = 0.0
+    self.finishedCallback = None
+    self.timer = qt.QTimer()
+    self.timer.connect('timeout()', self.onTimer)
+
+  def start(self, path, transformNodes, speed=1.0):
+    """Replays path into the nodes of the transformNodes name dictionary."""
+    from iGyneModelToTemplateRegistrationLib.TrackerRecording import readTrackerRecording
+    self.stop()
+    names, self.records = readTrackerRecording(path)
+    self.nodes = [transformNodes.get(name) for name in names]
+    self.times = numpy.array(self.records['time'])
+    self.next = 0
+    self.speed = speed
+    if len(self.records) == 0:
+      self.finish()
+      return
+    self.currentTime = self.times[0] * 1e-9
+    self.startTime = time.time()
+    self.timer.setInterval(0 if speed == 0 else self.interval)
+    self.timer.start()
+
+  def stop(self):
+    self.timer.stop()
+    self.records = None
+
+  def clock(self):
+    return self.currentTime
+
+  def onTimer(self):
+    if self.speed == 0:
+      end = min(self.next + self.batchSize, len(self.records))
+    else:
+      sessionTime = self.times[0] + int((time.time() - self.startTime) * self.speed * 1e9)
+      end = numpy.searchsorted(self.times, sessionTime, side='right')
+    for k in xrange(self.next, end):
+      record = self.records[k]
+      node = self.nodes[record['stream']]
+      self.currentTime = record['time'] * 1e-9
+      self.next = k + 1
+      if node != None:
+        setTransformNodeMatrix(node, record['matrix'])
+    if self.next >= len(self.records):
+      self.finish()
+
+  def finish(self):
+    self.stop()
+    if self.finishedCallback is not None:
+      self.finishedCallback()
+
+#
+# VTK helpers
+#
+
+def polyDataPointsAndNormals(polyData):
+  """Vertices and vertex normals of a surface as Nx3 numpy arrays."""
+  from vtk.util import numpy_support
+  normalsFilter = vtk.vtkPolyDataNormals()
+  normalsFilter.SetInput(polyData)
+  normalsFilter.SplittingOff()
+  normalsFilter.ConsistencyOn()
+  normalsFilter.ComputePointNormalsOn()
+  normalsFilter.Update()
+  output = normalsFilter.GetOutput()
+  points = numpy_support.vtk_to_numpy(output.GetPoints().GetData()).astype(numpy.float64)
+  normals = numpy_support.vtk_to_numpy(output.GetPointData().GetNormals()).astype(numpy.float64)
+  return points, normals
+
+def arrayFromVTKMatrix(m):
+  """Copies a vtkMatrix4x4 into a 4x4 numpy array."""
+  matrix = numpy.identity(4)
+  for row in xrange(4):
+    for column in xrange(4):
+      matrix[row, column] = m.GetElement(row, column)
+  return matrix
+
+def setTransformNodeMatrix(transformNode, matrix):
+  """Copies a 4x4 numpy array into a linear transform node."""
+  m = vtk.vtkMatrix4x4()
+  for row in xrange(4):
+    for column in xrange(4):
+      m.SetElement(row, column, matrix[row, column])
+  transformNode.GetMatrixTransformToParent().DeepCopy(m)
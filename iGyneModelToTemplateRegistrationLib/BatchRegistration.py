@@ -0,0 +1,129 @@
+"""Registers every session file of a directory, spread over a process pool,
+and writes one results table with the RMS, the residuals and the runtime
+of each session. Session files are the .npz files written by
+RegistrationLogic.saveSession, and the .trk tracker recordings of the
+module. A recording holds no model landmarks, so they are given once for
+all the recordings with --model-landmarks, in world coordinates, and the
+landmarks are the stylus dwells of the recording. A recording with a
+session file of the same name is registered from the session file. Run it
+without Slicer from the module directory:
+
+  python -m iGyneModelToTemplateRegistrationLib.BatchRegistration sessions results.csv --processes 4
+  python -m iGyneModelToTemplateRegistrationLib.BatchRegistration recordings results.csv --model-landmarks template.fcsv
+"""
+import argparse
+import csv
+import glob
+import multiprocessing
+import os
+import sys
+import time
+
+resultColumns = ['session', 'landmarks', 'transform', 'rms', 'maximumResidual', 'residuals',
+  'surfaceRMS', 'iterations', 'surfaceNote', 'runtimeMs', 'error']
+
+def registerSession(path, options=None):
+  """Registers one session file or tracker recording and returns its
+  results row. A failing session is reported in the error column instead
+  of stopping the batch. The options are those of main, as a dictionary."""
+  # imported here, so a worker only loads numpy once it gets a session
+  from iGyneModelToTemplateRegistrationLib.RegistrationLogic import RegistrationLogic
+  options = options or {}
+  row = dict.fromkeys(resultColumns, '')
+  row['session'] = os.path.basename(path)
+  start = time.time()
+  try:
+    logic = RegistrationLogic()
+    if path.endswith('.trk'):
+      if options.get('modelLandmarks') is None:
+        raise ValueError("tracker recordings need --model-landmarks")
+      logic.loadTrackerRecording(path, options['modelLandmarks'], options.get('stream', 'Stylus'),
+        options.get('dwellTime', 1.0), options.get('dwellTolerance', 0.5))
+      similarity, surfaceIndex = options.get('similarity', False), None
+    else:
+      similarity, surfaceIndex = logic.loadSession(path)
+    matrix, rms, residuals = logic.register(logic.modelLandmarks, similarity, surfaceIndex)
+    row['landmarks'] = len(logic.landmarks)
+    row['transform'] = 'Similarity' if similarity else 'Rigid'
+    row['rms'] = '%.4f' % rms
+    row['maximumResidual'] = '%.4f' % residuals.max()
+    row['residuals'] = ' '.join('%.4f' % residual for residual in residuals)
+    if logic.surfaceResult is not None:
+      iterations, timePerIteration, surfaceRMS = logic.surfaceResult
+      row['surfaceRMS'] = '%.4f' % surfaceRMS
+      row['iterations'] = iterations
+    row['surfaceNote'] = logic.surfaceNote or ''
+  except Exception as e:
+    row['error'] = '%s: %s' % (e.__class__.__name__, e)
+  row['runtimeMs'] = '%.2f' % (1000 * (time.time() - start))
+  return row
+
+def registerSessionTask(task):
+  # pool workers take a single picklable argument
+  return registerSession(*task)
+
+def registerSessions(paths, processes=None, options=None):
+  """Results rows of the session files, in the order of the paths."""
+  if processes == 1 or len(paths) <= 1:
+    return [registerSession(path, options) for path in paths]
+  pool = multiprocessing.Pool(processes)
+  try:
+    return pool.map(registerSessionTask, [(path, options) for path in paths], chunksize=1)
+  finally:
+    pool.close()
+    pool.join()
+
+def readModelLandmarks(path):
+  """Nx3 model landmarks from a Slicer markups .fcsv file, a comma
+  separated x,y,z file, or the 'modelLandmarks' of a session file."""
+  import numpy
+  if path.endswith('.npz'):
+    return numpy.load(path)['modelLandmarks']
+  # markups files start with an id column
+  columns = (1, 2, 3) if path.endswith('.fcsv') else (0, 1, 2)
+  return numpy.loadtxt(path, delimiter=',', usecols=columns, comments='#', ndmin=2)
+
+def sessionPaths(directory, patterns):
+  """The files matching any of the patterns, without the recordings that
+  have a session file of the same name."""
+  paths = sorted(set(path for pattern in patterns for path in glob.glob(os.path.join(directory, pattern))))
+  sessions = set(os.path.splitext(path)[0] for path in paths if path.endswith('.npz'))
+  return [path for path in paths if not (path.endswith('.trk') and os.path.splitext(path)[0] in sessions)]
+
+def writeResults(rows, output):
+  with open(output, 'wb') as f:
+    writer = csv.DictWriter(f, resultColumns)
+    writer.writerow(dict(zip(resultColumns, resultColumns)))
+    writer.writerows(rows)
+
+def main(argv=None):
+  parser = argparse.ArgumentParser(description="Register a directory of recorded iGyne sessions.")
+  parser.add_argument('sessionDirectory', help="directory of session files and tracker recordings")
+  parser.add_argument('output', help="results table, comma separated")
+  parser.add_argument('--pattern', action='append', help="session file name pattern, can be repeated (default: *.npz and *.trk)")
+  parser.add_argument('--processes', type=int, default=None, help="worker processes (default: one per CPU)")
+  parser.add_argument('--model-landmarks', help="model landmarks of the tracker recordings in world coordinates, .fcsv, .csv or session .npz")
+  parser.add_argument('--similarity', action='store_true', help="register the tracker recordings with a similarity transform")
+  parser.add_argument('--stream', default='Stylus', help="stylus stream of the tracker recordings (default: %(default)s)")
+  parser.add_argument('--dwell-time', type=float, default=1.0, help="seconds the stylus stays still on a landmark (default: %(default)s)")
+  parser.add_argument('--dwell-tolerance', type=float, default=0.5, help="mm the stylus moves at most during a dwell (default: %(default)s)")
+  args = parser.parse_args(argv)
+
+  patterns = args.pattern or ['*.npz', '*.trk']
+  paths = sessionPaths(args.sessionDirectory, patterns)
+  if not paths:
+    print "No session files matching %s in %s" % (' or '.join(patterns), args.sessionDirectory)
+    return 1
+  options = {'similarity': args.similarity, 'stream': args.stream,
+    'dwellTime': args.dwell_time, 'dwellTolerance': args.dwell_tolerance, 'modelLandmarks': None}
+  if args.model_landmarks:
+    options['modelLandmarks'] = readModelLandmarks(args.model_landmarks)
+  start = time.time()
+  rows = registerSessions(paths, args.processes, options)
+  writeResults(rows, args.output)
+  failed = sum(1 for row in rows if row['error'])
+  print "Registered %d sessions in %.1f s, %d failed, results in %s" % (len(rows), time.time() - start, failed, args.output)
+  return 0 if failed == 0 else 2
+
+if __name__ == '__main__':
+  sys.exit(main())
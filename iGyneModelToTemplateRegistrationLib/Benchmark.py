@@ -0,0 +1,325 @@
+"""Benchmarks the module workflow outside Slicer: the module file is loaded
+against the SceneStandIns, a synthetic tracker drives the stylus and the
+reference transform nodes, and the widget collects, registers and attaches
+as it would in a session. Reports throughput and latency percentiles for
+growing numbers of landmarks and for a long session of repeated
+registrations, next to the per-stage timings of the stageTimer. Each case
+is also checked: the registration has to recover the synthetic one, the
+stages have to stay within their latency limits, and the long session must
+neither add scene nodes nor grow in memory; the exit code is 1 when a check
+fails. With --transform-points, only the vectorized point transform is
+timed against a point by point loop.
+
+  python -m iGyneModelToTemplateRegistrationLib.Benchmark --landmarks 6 20 100 1000 --session 500 --csv cases.csv --json stages.json
+"""
+import argparse
+import imp
+import json
+import os
+import sys
+import time
+import numpy
+from iGyneModelToTemplateRegistrationLib import SceneStandIns
+from iGyneModelToTemplateRegistrationLib.Instrumentation import stageTimer
+from iGyneModelToTemplateRegistrationLib.LandmarkRegistration import rotationFromVector, transformPoints
+
+modulePath = os.path.join(os.path.dirname(os.path.dirname(os.path.abspath(__file__))), 'iGyneModelToTemplateRegistration.py')
+
+# p95 limits in ms of the stages and of a whole registration, for the cases
+# up to the given number of landmarks: the landmark diagnostics and the
+# correspondence search have to stay interactive for the usual protocols
+latencyLimits = [
+  (20, {'diagnostics': 50.0, 'correspondence': 100.0, 'register': 100.0}),
+  (1000, {'diagnostics': 1000.0, 'register': 1000.0}),
+]
+
+# the correspondence search is timed in the cases up to this many landmarks
+maximumMatchedLandmarks = 20
+
+class SyntheticTracker:
+  """Stylus and reference tracker streams at a fixed rate on a simulated
+  clock, which also stamps the stylus samples."""
+  def __init__(self, stylusNode, referenceNode, rate=100.0, noise=0.2, seed=0):
+    self.stylusNode = stylusNode
+    self.referenceNode = referenceNode
+    self.interval = 1.0 / rate
+    self.noise = noise
+    self.random = numpy.random.RandomState(seed)
+    self.time = 1.0
+    self.updates = 0
+
+  def clock(self):
+    return self.time
+
+  def step(self, tip):
+    """One tracker frame: the stylus tip near tip, the reference jittering."""
+    self.time += self.interval
+    matrix = numpy.identity(4)
+    matrix[:3,3] = tip + self.random.randn(3) * self.noise
+    self.stylusNode.GetMatrixTransformToParent().DeepCopy(matrix)
+    matrix[:3,3] = self.random.randn(3) * self.noise
+    self.referenceNode.GetMatrixTransformToParent().DeepCopy(matrix)
+    self.updates += 2
+
+  def dwell(self, tip, frames):
+    for frame in xrange(frames):
+      self.step(tip)
+
+class Workflow:
+  """A freshly loaded module with a stand-in scene holding a template under
+  a two-level transform chain, model fiducials, stylus, reference and an
+  image to attach, and the widget set up on them. The stand-ins are only
+  put into __main__ while the module is loaded and set up."""
+  def __init__(self, numberOfLandmarks, seed=0):
+    with SceneStandIns.Installed() as self.scene:
+      self.module = imp.load_source('iGyneModelToTemplateRegistration', modulePath)
+      self.setup(numberOfLandmarks, seed)
+
+  def setup(self, numberOfLandmarks, seed):
+    slicer = self.module.slicer
+    random = numpy.random.RandomState(seed)
+
+    chain = [self.addTransform(slicer, 'TableToWorld', random), self.addTransform(slicer, 'TemplateToTable', random)]
+    chain[1].SetAndObserveTransformNodeID(chain[0].GetID())
+    self.template = self.scene.AddNode(slicer.vtkMRMLModelNode())
+    self.template.SetAndObserveTransformNodeID(chain[1].GetID())
+    self.modelFiducials = self.scene.AddNode(slicer.vtkMRMLMarkupsFiducialNode())
+    modelPoints = random.rand(numberOfLandmarks, 3) * 80
+    for i, point in enumerate(modelPoints):
+      self.modelFiducials.AddFiducial(*point)
+      self.modelFiducials.SetNthFiducialLabel(i, 'L%d' % (i+1))
+    self.stylus = self.scene.AddNode(slicer.vtkMRMLLinearTransformNode())
+    self.reference = self.scene.AddNode(slicer.vtkMRMLLinearTransformNode())
+    self.image = self.scene.AddNode(slicer.vtkMRMLLinearTransformNode())
+
+    # stylus tips that the true registration maps onto the model fiducials
+    templateToWorld = numpy.identity(4)
+    for transformNode in chain:
+      templateToWorld = numpy.dot(templateToWorld, transformNode.GetMatrixTransformToParent().elements)
+    registration = numpy.identity(4)
+    registration[:3,:3] = rotationFromVector(random.randn(3) * 0.5)
+    registration[:3,3] = random.randn(3) * 30
+    self.registration = registration
+    self.tips = transformPoints(numpy.linalg.inv(registration), transformPoints(templateToWorld, modelPoints))
+
+    self.widget = self.module.iGyneModelToTemplateRegistrationWidget(SceneStandIns.StandIn())
+    self.widget.setup()
+    self.widget.templateSelector.currentNode = lambda: self.template
+    self.widget.stylusTrackerSelector.currentNode = lambda: self.stylus
+    self.widget.modelFiducialSelector.currentNode = lambda: self.modelFiducials
+    self.widget.referenceTrackerSelector.currentNode = lambda: self.reference
+    self.widget.childNodeSelector.currentNode = lambda: self.image
+    self.widget.holesSelector.currentNode = lambda: None
+    self.tracker = SyntheticTracker(self.stylus, self.reference, seed=seed)
+    self.widget.stylusSampler.setTransformNode(self.stylus)
+    self.widget.stylusSampler.clock = self.tracker.clock
+    self.widget.onModelFiducialsChanged()
+
+  def addTransform(self, slicer, name, random):
+    transformNode = self.scene.AddNode(slicer.vtkMRMLLinearTransformNode())
+    transformNode.SetName(name)
+    matrix = numpy.identity(4)
+    matrix[:3,:3] = rotationFromVector(random.randn(3) * 0.2)
+    matrix[:3,3] = random.randn(3) * 50
+    transformNode.GetMatrixTransformToParent().DeepCopy(matrix)
+    return transformNode
+
+  def collect(self, framesPerLandmark=30):
+    """Collects every landmark after dwelling on it, returns the latencies."""
+    latencies = []
+    self.widget.onPointResetButtonClicked()
+    for tip in self.tips:
+      self.tracker.dwell(tip, framesPerLandmark)
+      start = time.time()
+      self.widget.onPointCollectionButtonClicked()
+      latencies.append(time.time() - start)
+    return latencies
+
+  def register(self):
+    start = time.time()
+    self.widget.onRegistrationButtonClicked()
+    job = self.widget.registrationJob
+    if job is not None:
+      job.join()
+      self.widget.onRegistrationTimer()
+    return time.time() - start
+
+  def registrationError(self):
+    """Largest distance between the landmarks moved by the module's
+    registration and by the synthetic one."""
+    matrix = self.widget.logic.matrix
+    difference = transformPoints(matrix, self.tips) - transformPoints(self.registration, self.tips)
+    return numpy.sqrt((difference**2).sum(axis=1)).max()
+
+  def attach(self, frames=100):
+    """Attaches and pushes the reference updates of frames tracker frames."""
+    self.widget.onAttachButtonClicked()
+    for frame in xrange(frames):
+      self.tracker.step(self.tips[0])
+      self.widget.referenceAttachment.push()
+
+class Quiet:
+  """Swallows the module's console output while the workflow runs."""
+  def __enter__(self):
+    self.stdout = sys.stdout
+    sys.stdout = open(os.devnull, 'w')
+
+  def __exit__(self, exceptionType, exception, traceback):
+    sys.stdout.close()
+    sys.stdout = self.stdout
+    return False
+
+def percentiles(latencies, values=(50, 95, 99)):
+  return list(1000 * numpy.percentile(latencies, values))
+
+def benchmarkLandmarks(numberOfLandmarks, registrations=20):
+  """Collection and registration latencies for one number of landmarks."""
+  stageTimer.reset()
+  with Quiet():
+    workflow = Workflow(numberOfLandmarks)
+    workflow.widget.autoCorrespondenceCheckBox.checked = numberOfLandmarks <= maximumMatchedLandmarks
+    collectLatencies = workflow.collect()
+    start = time.time()
+    registerLatencies = [workflow.register() for registration in xrange(registrations)]
+    elapsed = time.time() - start
+    workflow.attach()
+  row = {'case': '%d landmarks' % numberOfLandmarks, 'landmarks': numberOfLandmarks,
+    'registrationsPerSecond': registrations / elapsed,
+    'rms': workflow.widget.RMS, 'noise': workflow.tracker.noise,
+    'registrationError': workflow.registrationError()}
+  for name, latencies in (('collect', collectLatencies), ('register', registerLatencies)):
+    for percentile, value in zip((50, 95, 99), percentiles(latencies)):
+      row['%sP%dMs' % (name, percentile)] = value
+  return row, stageTimer.summary()
+
+def benchmarkSession(cycles=500, numberOfLandmarks=6):
+  """Repeated collect, register and attach cycles in one scene, to expose
+  latency drift and scene or memory growth over a long session."""
+  stageTimer.reset()
+  with Quiet():
+    workflow = Workflow(numberOfLandmarks)
+    workflow.collect()
+    workflow.register()
+    workflow.attach()
+    nodesBefore = workflow.scene.GetNumberOfNodes()
+    memoryBefore = workflow.module.residentMemory()
+    latencies = []
+    start = time.time()
+    for cycle in xrange(cycles):
+      cycleStart = time.time()
+      workflow.collect()
+      workflow.register()
+      workflow.attach(frames=10)
+      latencies.append(time.time() - cycleStart)
+    elapsed = time.time() - start
+  tenth = max(cycles // 10, 1)
+  row = {'case': 'session of %d cycles' % cycles, 'landmarks': numberOfLandmarks,
+    'cyclesPerSecond': cycles / elapsed,
+    'drift': numpy.mean(latencies[-tenth:]) / numpy.mean(latencies[:tenth]),
+    'nodesAdded': workflow.scene.GetNumberOfNodes() - nodesBefore,
+    'memoryGrowthMB': (workflow.module.residentMemory() - memoryBefore) / 1048576.0}
+  for percentile, value in zip((50, 95, 99), percentiles(latencies)):
+    row['cycleP%dMs' % percentile] = value
+  return row, stageTimer.summary()
+
+def benchmarkTransformPoints(sizes=(6, 100, 1000, 10000, 100000), repeats=20):
+  """Times transformPoints against the former point by point loop, to see
+  how the transform of the model fiducials and of the template surface
+  scales with the number of points."""
+  matrix = numpy.identity(4)
+  matrix[:3,:3] = 1.5 * rotationFromVector(numpy.array([0.1, 0.2, 0.3]))
+  matrix[:3,3] = [10, 20, 30]
+  rows = []
+  print "%10s %14s %14s %16s" % ("points", "vectorized ms", "loop ms", "points per s")
+  for size in sizes:
+    points = numpy.random.rand(size, 3) * 100
+    start = time.time()
+    for repeat in xrange(repeats):
+      transformPoints(matrix, points)
+    vectorized = (time.time() - start) / repeats
+    # the loop is only timed once on the large sizes
+    loopPoints = points[:min(size, 10000)]
+    start = time.time()
+    for point in loopPoints:
+      numpy.add(numpy.dot(matrix[:3,:3], point), matrix[:3,3])
+    loop = (time.time() - start) * size / len(loopPoints)
+    rows.append((size, vectorized, loop))
+    print "%10d %14.3f %14.3f %16.0f" % (size, 1000 * vectorized, 1000 * loop, size / max(vectorized, 1e-9))
+  return rows
+
+def failedChecks(row, stages=(), maximumError=0.5, maximumMemoryGrowthMB=20.0):
+  """Descriptions of the checks a case fails: a registration more than
+  maximumError mm off the synthetic one, or with an RMS above twice the 3D
+  tracker noise, a registration or a stage slower at p95 than its limit in
+  latencyLimits, and a session that added scene nodes or grew by more than
+  maximumMemoryGrowthMB."""
+  failures = []
+  limits = [limits for largestCase, limits in latencyLimits if row['landmarks'] <= largestCase]
+  latencies = dict((stage['stage'], stage['p95Ms']) for stage in stages)
+  if 'registerP95Ms' in row:
+    latencies['register'] = row['registerP95Ms']
+  for name, limit in sorted(limits[0].items() if limits else []):
+    if latencies.get(name, 0) > limit:
+      failures.append('%s p95 %.1f ms above %.0f ms' % (name, latencies[name], limit))
+  if 'registrationError' in row:
+    if not row['registrationError'] <= maximumError:
+      failures.append('registration %.3f mm off the synthetic one' % row['registrationError'])
+    if not row['rms'] <= 2 * numpy.sqrt(3) * row['noise']:
+      failures.append('RMS %.3f mm above twice the tracker noise' % row['rms'])
+  if row.get('nodesAdded', 0) != 0:
+    failures.append('%d scene nodes added' % row['nodesAdded'])
+  if row.get('memoryGrowthMB', 0) > maximumMemoryGrowthMB:
+    failures.append('memory grew by %.1f MB' % row['memoryGrowthMB'])
+  return failures
+
+def main(argv=None):
+  parser = argparse.ArgumentParser(description="Benchmark the iGyne registration workflow against stand-in Slicer nodes.")
+  parser.add_argument('--landmarks', type=int, nargs='*', default=[6, 20, 100, 1000], help="numbers of landmarks (default: %(default)s)")
+  parser.add_argument('--registrations', type=int, default=20, help="registrations per number of landmarks (default: %(default)s)")
+  parser.add_argument('--session', type=int, default=500, help="cycles of the long session, 0 to skip (default: %(default)s)")
+  parser.add_argument('--csv', help="write one row per case to this file")
+  parser.add_argument('--json', help="write the cases and their stage timings to this file")
+  parser.add_argument('--transform-points', action='store_true', help="time transformPoints against a point by point loop and exit")
+  parser.add_argument('--memory-limit', type=float, default=20.0, help="MB the long session may grow by (default: %(default)s)")
+  args = parser.parse_args(argv)
+  if args.transform_points:
+    benchmarkTransformPoints()
+    return 0
+
+  results = []
+  print "%-24s %10s %14s %14s %14s %14s" % ("case", "per second", "collect p50", "register p50", "register p95", "register p99")
+  for numberOfLandmarks in args.landmarks:
+    row, stages = benchmarkLandmarks(numberOfLandmarks, args.registrations)
+    results.append((row, stages))
+    print "%-24s %10.1f %11.3f ms %11.3f ms %11.3f ms %11.3f ms" % (row['case'], row['registrationsPerSecond'], row['collectP50Ms'], row['registerP50Ms'], row['registerP95Ms'], row['registerP99Ms'])
+  if args.session:
+    row, stages = benchmarkSession(args.session)
+    results.append((row, stages))
+    print "%-24s %10.1f cycles/s, p50 %.3f ms, p95 %.3f ms, p99 %.3f ms, drift x%.2f, %d nodes added, %+.1f MB" % (row['case'], row['cyclesPerSecond'], row['cycleP50Ms'], row['cycleP95Ms'], row['cycleP99Ms'], row['drift'], row['nodesAdded'], row['memoryGrowthMB'])
+  for row, stages in results:
+    print
+    print row['case']
+    print "%-24s %8s %10s %9s %9s %9s" % ("stage", "count", "mean ms", "p50 ms", "p95 ms", "p99 ms")
+    for stage in stages:
+      print "%-24s %8d %10.3f %9.3f %9.3f %9.3f" % (stage['stage'], stage['count'], stage['meanMs'], stage['p50Ms'], stage['p95Ms'], stage['p99Ms'])
+
+  if args.csv:
+    columns = sorted(set(key for row, stages in results for key in row))
+    columns.remove('case')
+    with open(args.csv, 'w') as f:
+      f.write(','.join(['case'] + columns) + '\n')
+      for row, stages in results:
+        f.write(','.join([row['case']] + [str(row.get(column, '')) for column in columns]) + '\n')
+  if args.json:
+    with open(args.json, 'w') as f:
+      json.dump([dict(row, stages=stages) for row, stages in results], f, indent=1)
+
+  failures = ['%s: %s' % (row['case'], failure) for row, stages in results for failure in failedChecks(row, stages, maximumMemoryGrowthMB=args.memory_limit)]
+  print
+  for failure in failures:
+    print "FAILED", failure
+  print "%d cases, %d checks failed" % (len(results), len(failures))
+  return 1 if failures else 0
+
+if __name__ == '__main__':
+  sys.exit(main())
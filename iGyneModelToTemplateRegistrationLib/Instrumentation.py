@@ -0,0 +1,113 @@
+"""Per-stage timing of the iGyne model to template registration workflow.
+The module and the logic record every stage into the shared stageTimer;
+from the Python console:
+
+  from iGyneModelToTemplateRegistrationLib.Instrumentation import stageTimer
+  stageTimer.report()
+  stageTimer.dumpCSV('/tmp/stages.csv')
+"""
+import json
+import time
+import numpy
+
+class StageTimer:
+  """In-memory histogram of the durations of each named stage, in
+  logarithmic bins from minimum to maximum seconds, next to the exact
+  count, total, minimum and maximum. Recording costs one binary search,
+  so it can stay on in the tracker observers. Percentiles are read from
+  the histogram, accurate to the bin width (about 12% at 20 bins per
+  decade)."""
+  def __init__(self, minimum=1e-7, maximum=100.0, binsPerDecade=20):
+    decades = numpy.log10(maximum) - numpy.log10(minimum)
+    self.edges = numpy.logspace(numpy.log10(minimum), numpy.log10(maximum), int(round(decades * binsPerDecade)) + 1)
+    self.enabled = True
+    self.reset()
+
+  def reset(self):
+    self.counts = {}
+    self.totals = {}
+    self.minima = {}
+    self.maxima = {}
+
+  def record(self, stage, seconds):
+    if not self.enabled:
+      return
+    counts = self.counts.get(stage)
+    if counts is None:
+      # one underflow and one overflow bin around the edges
+      counts = self.counts[stage] = numpy.zeros(len(self.edges) + 1, dtype=numpy.int64)
+      self.totals[stage] = 0.0
+      self.minima[stage] = seconds
+      self.maxima[stage] = seconds
+    counts[numpy.searchsorted(self.edges, seconds)] += 1
+    self.totals[stage] += seconds
+    self.minima[stage] = min(self.minima[stage], seconds)
+    self.maxima[stage] = max(self.maxima[stage], seconds)
+
+  def measure(self, stage):
+    """Context manager recording the time spent in its block."""
+    return StageMeasurement(self, stage)
+
+  def stages(self):
+    return sorted(self.counts.keys())
+
+  def percentiles(self, stage, percentiles=(50, 95, 99)):
+    """Durations in seconds at the given percentiles, from the geometric
+    center of the bin each falls into, clipped to the exact extremes."""
+    counts = self.counts[stage]
+    cumulative = numpy.cumsum(counts)
+    ranks = numpy.asarray(percentiles, dtype=numpy.float64) / 100 * cumulative[-1]
+    bins = numpy.minimum(numpy.searchsorted(cumulative, numpy.maximum(ranks, 1)), len(counts) - 1)
+    # bin i lies between edges[i-1] and edges[i]
+    lower = self.edges[numpy.maximum(bins - 1, 0)]
+    upper = self.edges[numpy.minimum(bins, len(self.edges) - 1)]
+    return numpy.clip(numpy.sqrt(lower * upper), self.minima[stage], self.maxima[stage])
+
+  def summary(self, percentiles=(50, 95, 99)):
+    """One row per stage with its count and durations in milliseconds."""
+    rows = []
+    for stage in self.stages():
+      count = int(self.counts[stage].sum())
+      row = {'stage': stage, 'count': count,
+        'totalMs': 1000 * self.totals[stage],
+        'meanMs': 1000 * self.totals[stage] / count,
+        'minimumMs': 1000 * self.minima[stage],
+        'maximumMs': 1000 * self.maxima[stage]}
+      for percentile, value in zip(percentiles, self.percentiles(stage, percentiles)):
+        row['p%gMs' % percentile] = 1000 * value
+      rows.append(row)
+    return rows
+
+  def report(self, percentiles=(50, 95, 99)):
+    print "%-24s %8s %10s" % ("stage", "count", "mean ms") + "".join(" %9s" % ("p%g ms" % p) for p in percentiles) + " %10s" % "max ms"
+    for row in self.summary(percentiles):
+      print "%-24s %8d %10.3f" % (row['stage'], row['count'], row['meanMs']) + "".join(" %9.3f" % row['p%gMs' % p] for p in percentiles) + " %10.3f" % row['maximumMs']
+
+  def dumpCSV(self, path, percentiles=(50, 95, 99)):
+    columns = ['stage', 'count', 'totalMs', 'meanMs', 'minimumMs', 'maximumMs'] + ['p%gMs' % p for p in percentiles]
+    with open(path, 'w') as f:
+      f.write(','.join(columns) + '\n')
+      for row in self.summary(percentiles):
+        f.write(','.join(str(row[column]) for column in columns) + '\n')
+
+  def dumpJSON(self, path, percentiles=(50, 95, 99)):
+    """Writes the summary and the raw histograms, with their bin edges in seconds."""
+    histograms = dict((stage, self.counts[stage].tolist()) for stage in self.stages())
+    with open(path, 'w') as f:
+      json.dump({'edges': self.edges.tolist(), 'summary': self.summary(percentiles), 'histograms': histograms}, f, indent=1)
+
+class StageMeasurement:
+  def __init__(self, timer, stage):
+    self.timer = timer
+    self.stage = stage
+    self.start = 0
+
+  def __enter__(self):
+    self.start = time.time()
+    return self
+
+  def __exit__(self, exceptionType, exception, traceback):
+    self.timer.record(self.stage, time.time() - self.start)
+    return False
+
+stageTimer = StageTimer()
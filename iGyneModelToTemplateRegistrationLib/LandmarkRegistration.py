@@ -0,0 +1,678 @@
+"""Numeric core of the iGyne model to template registration: collected
+landmarks, landmark and surface registration and their diagnostics. Only
+numpy is needed, so this runs without Slicer, Qt or VTK."""
+import numpy
+import itertools
+import threading
+import time
+
+#
+# Landmarks
+#
+
+defaultLandmarkNames = ['Ec O', 'Ef I', 'Ce I', 'Cn O', 'Eb O', 'Eb I']
+
+class LandmarkStore:
+  """Collected landmarks of a template, kept in one preallocated float64 
+  array with parallel name, status and timestamp columns. The landmarks 
+  are collected in order, each at the first index still missing; the 
+  arrays grow geometrically when a larger template is defined."""
+  def __init__(self, names=(), capacity=8):
+    self.points = numpy.zeros((capacity, 3))
+    self.collected = numpy.zeros(capacity, dtype=bool)
+    self.timestamps = numpy.zeros(capacity)
+    self.names = []
+    self.define(names)
+
+  def __len__(self):
+    return len(self.names)
+
+  def define(self, names):
+    """Starts over with one empty landmark per name."""
+    self.names = list(names)
+    self.reserve(len(self.names))
+    self.reset()
+
+  def reset(self):
+    self.points[:] = 0
+    self.collected[:] = False
+    self.timestamps[:] = 0
+
+  def reserve(self, size):
+    capacity = len(self.points)
+    if size <= capacity:
+      return
+    while capacity < size:
+      capacity *= 2
+    points = numpy.zeros((capacity, 3))
+    points[:len(self.points)] = self.points
+    collected = numpy.zeros(capacity, dtype=bool)
+    collected[:len(self.collected)] = self.collected
+    timestamps = numpy.zeros(capacity)
+    timestamps[:len(self.timestamps)] = self.timestamps
+    self.points, self.collected, self.timestamps = points, collected, timestamps
+
+  def setPoint(self, index, point, timestamp=0):
+    self.points[index] = point
+    self.collected[index] = True
+    self.timestamps[index] = timestamp
+
+  def numberOfCollectedPoints(self):
+    return int(self.collected[:len(self.names)].sum())
+
+  def nextIndex(self):
+    """Index of the first landmark not collected yet, len(self) once all are."""
+    missing = numpy.flatnonzero(~self.collected[:len(self.names)])
+    return int(missing[0]) if len(missing) > 0 else len(self.names)
+
+  def coordinates(self):
+    """Nx3 view of the landmark coordinates, no copy is made."""
+    return self.points[:len(self.names)]
+
+#
+# Background registration
+#
+
+class RegistrationJob(threading.Thread):
+  """Runs the landmark solve, and the optional surface refinement, on a 
+  worker thread. Only numpy copies of the points and the prebuilt surface 
+  index cross the thread boundary, the scene is updated by the widget on 
+  the main thread once the job has finished."""
+  def __init__(self, fixedPoints, movingPoints, similarity=False, surfaceIndex=None, sweepPoints=None,
+      minimumSweepPoints=100, maximumLandmarkRMSIncrease=0.5):
+    threading.Thread.__init__(self)
+    self.daemon = True
+    self.fixedPoints = numpy.array(fixedPoints, dtype=numpy.float64)
+    self.movingPoints = numpy.array(movingPoints, dtype=numpy.float64)
+    self.similarity = similarity
+    self.surfaceIndex = surfaceIndex
+    self.sweepPoints = numpy.zeros((0,3))
+    if sweepPoints is not None:
+      self.sweepPoints = numpy.array(sweepPoints, dtype=numpy.float64).reshape(-1, 3)
+    self.minimumSweepPoints = minimumSweepPoints
+    self.maximumLandmarkRMSIncrease = maximumLandmarkRMSIncrease
+    self.cancelled = False
+    self.progress = 0
+    self.result = None
+    # RMS of the landmark fit before the surface refinement
+    self.landmarkRMS = None
+    self.surfaceResult = None
+    # why a requested surface refinement was skipped or rejected
+    self.surfaceNote = None
+    self.error = None
+    self.elapsed = 0
+
+  def cancel(self):
+    self.cancelled = True
+
+  def run(self):
+    start = time.time()
+    try:
+      result = rigidLandmarkTransform(self.fixedPoints, self.movingPoints, self.similarity)
+      self.landmarkRMS = result[1]
+      if self.surfaceIndex is not None:
+        result = self.refine(result)
+      if not self.cancelled:
+        self.result = result
+    except Exception as e:
+      self.error = e
+    self.progress = 100
+    self.elapsed = time.time() - start
+
+  def refine(self, result):
+    """Fits the sweep and the landmarks to the surface, tied to the landmark 
+    pairs. Without a sweep of minimumSweepPoints the landmarks alone do not 
+    pin the fit to the surface, and a refinement that raises the landmark 
+    RMS by more than maximumLandmarkRMSIncrease mm has slid off them; both 
+    keep the landmark result."""
+    if len(self.sweepPoints) < self.minimumSweepPoints:
+      self.surfaceNote = 'surface refinement skipped, %d of %d sweep points' % (len(self.sweepPoints), self.minimumSweepPoints)
+      return result
+    self.progress = 10
+    surfacePoints = numpy.vstack((self.sweepPoints, self.movingPoints))
+    matrix, surfaceRMS, iterations, timePerIteration = refineSurfaceRegistration(self.surfaceIndex, surfacePoints, result[0],
+      fixedLandmarks=self.fixedPoints, movingLandmarks=self.movingPoints, job=self)
+    residuals = landmarkResiduals(matrix, self.fixedPoints, self.movingPoints)
+    rms = numpy.sqrt((residuals**2).mean())
+    if rms > self.landmarkRMS + self.maximumLandmarkRMSIncrease:
+      self.surfaceNote = 'surface refinement rejected, landmark RMS %.2f mm against %.2f mm' % (rms, self.landmarkRMS)
+      return result
+    self.surfaceResult = (iterations, timePerIteration, surfaceRMS)
+    return matrix, rms, residuals
+
+#
+# Surface refinement
+#
+
+class SurfacePointIndex:
+  """Uniform grid over the surface vertices for vectorized closest-vertex 
+  queries. Vertices are sorted by grid cell and a query searches growing 
+  rings of cells around its own cell, stopping once the closest vertex 
+  found is nearer than the ring. Queries still unresolved after the last 
+  ring, which lie far from the surface, are searched cell by cell in order 
+  of their distance bound, or by a chunked brute-force search when there 
+  are many of them, so results are exact."""
+  def __init__(self, points, normals=None, cellSize=None):
+    self.points = numpy.asarray(points, dtype=numpy.float64)
+    self.normals = normals
+    self.origin = self.points.min(axis=0)
+    extent = self.points.max(axis=0) - self.origin
+    if cellSize is None:
+      # roughly ten vertices per occupied cell on a surface
+      cellSize = 4 * max(extent.max(), 1e-6) / numpy.sqrt(len(self.points))
+    self.cellSize = cellSize
+    cells = numpy.floor((self.points - self.origin) / cellSize).astype(numpy.int64)
+    self.dimensions = cells.max(axis=0) + 3
+    keys = self.cellKeys(cells)
+    self.order = numpy.argsort(keys, kind='mergesort')
+    self.keys, self.starts, self.counts = numpy.unique(keys[self.order], return_index=True, return_counts=True)
+    # lower corners of the occupied cells, for the distance bounds of far queries
+    padded = numpy.column_stack((self.keys // (self.dimensions[1] * self.dimensions[2]), (self.keys // self.dimensions[2]) % self.dimensions[1], self.keys % self.dimensions[2]))
+    self.cellCorners = self.origin + (padded - 1) * cellSize
+    self.ringOffsets = []
+    for ring in xrange(4):
+      span = range(-ring, ring+1)
+      self.ringOffsets.append(numpy.array([(i, j, k) for i in span for j in span for k in span if max(abs(i), abs(j), abs(k)) == ring]))
+
+  def cellKeys(self, cells):
+    # cells are padded by one so the neighbours of the border cells get valid keys
+    padded = cells + 1
+    return (padded[:,0] * self.dimensions[1] + padded[:,1]) * self.dimensions[2] + padded[:,2]
+
+  def closestPoints(self, queries, maximumBoundedQueries=32):
+    """Returns the index of, and the distance to, the closest vertex of every query point."""
+    queries = numpy.asarray(queries, dtype=numpy.float64)
+    best = numpy.empty(len(queries))
+    best.fill(numpy.inf)
+    bestIndex = numpy.zeros(len(queries), dtype=numpy.int64)
+    cells = numpy.floor((queries - self.origin) / self.cellSize).astype(numpy.int64)
+    pending = numpy.arange(len(queries))
+    for ring, offsets in enumerate(self.ringOffsets):
+      pendingQueries = queries[pending]
+      pendingCells = cells[pending]
+      pendingBest = best[pending]
+      pendingIndex = bestIndex[pending]
+      self.searchCells(pendingQueries, pendingCells, offsets, pendingBest, pendingIndex)
+      best[pending] = pendingBest
+      bestIndex[pending] = pendingIndex
+      # every vertex outside the searched rings is farther than ring cell sizes
+      pending = pending[pendingBest > (ring * self.cellSize)**2]
+      if len(pending) == 0:
+        break
+    if len(pending) > maximumBoundedQueries:
+      bestIndex[pending], best[pending] = self.bruteForceClosestPoints(queries[pending])
+    else:
+      for i in pending:
+        bestIndex[i], best[i] = self.boundedClosestPoint(queries[i])
+    return bestIndex, numpy.sqrt(best)
+
+  def searchCells(self, queries, cells, offsets, best, bestIndex):
+    """Updates best and bestIndex in place with the vertices of the cells at 
+    the given offsets around each query. All (query, vertex) pairs are laid 
+    out in one flat array, grouped by query, so nothing is padded."""
+    numberOfOffsets = len(offsets)
+    neighbours = (cells[:,numpy.newaxis,:] + offsets).reshape(-1, 3)
+    owners = numpy.repeat(numpy.arange(len(queries)), numberOfOffsets)
+    inside = ((neighbours >= 0) & (neighbours < self.dimensions - 2)).all(axis=1)
+    keys = self.cellKeys(neighbours[inside])
+    owners = owners[inside]
+    position = numpy.minimum(numpy.searchsorted(self.keys, keys), len(self.keys) - 1)
+    found = self.keys[position] == keys
+    position = position[found]
+    owners = owners[found]
+    counts = self.counts[position]
+    total = counts.sum()
+    if total == 0:
+      return
+    groupStarts = numpy.cumsum(counts) - counts
+    pairOwners = numpy.repeat(owners, counts)
+    slots = numpy.arange(total) - numpy.repeat(groupStarts, counts)
+    candidates = self.order[numpy.repeat(self.starts[position], counts) + slots]
+    distances = ((self.points[candidates] - queries[pairOwners])**2).sum(axis=1)
+    # pairs are grouped by query, so the first pair of each query starts its run
+    runStarts = numpy.flatnonzero(numpy.concatenate(([True], pairOwners[1:] != pairOwners[:-1])))
+    runMinima = numpy.minimum.reduceat(distances, runStarts)
+    runLengths = numpy.diff(numpy.append(runStarts, total))
+    isMinimum = numpy.flatnonzero(distances == numpy.repeat(runMinima, runLengths))
+    runOwners, first = numpy.unique(pairOwners[isMinimum], return_index=True)
+    nearest = isMinimum[first]
+    better = runMinima < best[runOwners]
+    best[runOwners[better]] = runMinima[better]
+    bestIndex[runOwners[better]] = candidates[nearest[better]]
+
+  def boundedClosestPoint(self, query):
+    """Squared distance to, and index of, the closest vertex of one query. 
+    Only the cells whose box is not farther than the vertices of the 
+    nearest box are searched."""
+    gap = numpy.maximum(numpy.maximum(self.cellCorners - query, query - self.cellCorners - self.cellSize), 0)
+    bounds = (gap**2).sum(axis=1)
+    nearestCell = bounds.argmin()
+    start = self.starts[nearestCell]
+    vertices = self.order[start:start + self.counts[nearestCell]]
+    upperBound = ((self.points[vertices] - query)**2).sum(axis=1).min()
+    cells = numpy.flatnonzero(bounds <= upperBound)
+    counts = self.counts[cells]
+    slots = numpy.arange(counts.sum()) - numpy.repeat(numpy.cumsum(counts) - counts, counts)
+    candidates = self.order[numpy.repeat(self.starts[cells], counts) + slots]
+    distances = ((self.points[candidates] - query)**2).sum(axis=1)
+    nearest = distances.argmin()
+    return candidates[nearest], distances[nearest]
+
+  def bruteForceClosestPoints(self, queries, chunkSize=64):
+    """Squared distances to, and indices of, the closest vertices by exhaustive search."""
+    squaredNorms = (self.points**2).sum(axis=1)
+    indices = numpy.zeros(len(queries), dtype=numpy.int64)
+    distances = numpy.zeros(len(queries))
+    for start in xrange(0, len(queries), chunkSize):
+      chunk = queries[start:start+chunkSize]
+      squared = squaredNorms - 2 * numpy.dot(chunk, self.points.T) + (chunk**2).sum(axis=1)[:,numpy.newaxis]
+      nearest = squared.argmin(axis=1)
+      indices[start:start+chunkSize] = nearest
+      distances[start:start+chunkSize] = numpy.maximum(squared[numpy.arange(len(chunk)), nearest], 0)
+    return indices, distances
+
+def rotationFromVector(rotationVector):
+  """Rodrigues' formula, the rotation by |v| radians around v."""
+  angle = numpy.sqrt((rotationVector**2).sum())
+  if angle < 1e-12:
+    return numpy.identity(3)
+  x, y, z = rotationVector / angle
+  k = numpy.array([[0, -z, y], [z, 0, -x], [-y, x, 0]])
+  return numpy.identity(3) + numpy.sin(angle) * k + (1 - numpy.cos(angle)) * numpy.dot(k, k)
+
+def refineSurfaceRegistration(surfaceIndex, points, initialMatrix, maximumIterations=30, trimFraction=0.9, tolerance=1e-3,
+    minimumStep=0.01, fixedLandmarks=None, movingLandmarks=None, landmarkWeight=1.0, job=None):
+  """Point-to-plane ICP of the stylus points onto the indexed surface, 
+  starting from the landmark transform. Only the trimFraction closest 
+  correspondences are used in each iteration. With landmark pairs, their 
+  point-to-point distances are fitted along, weighing landmarkWeight times 
+  the kept surface points in total, so a flat or symmetric surface cannot 
+  slide the fit away from them. The iterations stop once the fit error 
+  improves by less than the tolerance fraction, or the update moves no 
+  point by more than minimumStep mm. Returns the refined matrix, the final 
+  trimmed point-to-plane RMS, the number of iterations and the mean time 
+  per iteration."""
+  points = numpy.asarray(points, dtype=numpy.float64)
+  numberKept = min(len(points), max(6, int(trimFraction * len(points))))
+  if movingLandmarks is not None:
+    fixedLandmarks = numpy.asarray(fixedLandmarks, dtype=numpy.float64)
+    movingLandmarks = numpy.asarray(movingLandmarks, dtype=numpy.float64)
+    weight = numpy.sqrt(landmarkWeight * numberKept / (3.0 * len(movingLandmarks)))
+  matrix = numpy.array(initialMatrix, dtype=numpy.float64)
+  iterationTimes = []
+  previousRMS = None
+  for iteration in xrange(maximumIterations):
+    if job is not None and job.cancelled:
+      break
+    start = time.time()
+    moved = transformPoints(matrix, points)
+    indices, distances = surfaceIndex.closestPoints(moved)
+    kept = numpy.argsort(distances)[:numberKept]
+    source = moved[kept]
+    target = surfaceIndex.points[indices[kept]]
+    normals = surfaceIndex.normals[indices[kept]]
+    # linearized rotation about the centroid keeps the system well conditioned
+    center = source.mean(axis=0)
+    a = numpy.hstack((numpy.cross(source - center, normals), normals))
+    b = ((target - source) * normals).sum(axis=1)
+    if movingLandmarks is not None:
+      a, b = landmarkRows(a, b, transformPoints(matrix, movingLandmarks), fixedLandmarks, center, weight)
+    rms = numpy.sqrt((b**2).sum() / numberKept)
+    if previousRMS is not None and previousRMS - rms < tolerance * previousRMS:
+      break
+    previousRMS = rms
+    update = numpy.linalg.lstsq(a, b, rcond=-1)[0]
+    step = numpy.identity(4)
+    step[:3,:3] = rotationFromVector(update[:3])
+    step[:3,3] = center + update[3:] - numpy.dot(step[:3,:3], center)
+    matrix = numpy.dot(step, matrix)
+    iterationTimes.append(time.time() - start)
+    if job is not None:
+      job.progress = 10 + int(90 * (iteration + 1) / maximumIterations)
+    # largest displacement of a kept point by the update
+    radius = numpy.sqrt(((source - center)**2).sum(axis=1)).max()
+    if numpy.sqrt((update[:3]**2).sum()) * radius + numpy.sqrt((update[3:]**2).sum()) < minimumStep:
+      break
+  moved = transformPoints(matrix, points)
+  indices, distances = surfaceIndex.closestPoints(moved)
+  kept = numpy.argsort(distances)[:numberKept]
+  planeDistances = ((surfaceIndex.points[indices[kept]] - moved[kept]) * surfaceIndex.normals[indices[kept]]).sum(axis=1)
+  rms = numpy.sqrt((planeDistances**2).mean())
+  timePerIteration = numpy.mean(iterationTimes) if iterationTimes else 0.0
+  return matrix, rms, len(iterationTimes), timePerIteration
+
+def landmarkRows(a, b, moved, fixed, center, weight):
+  """Appends the weighted point-to-point rows of the landmark pairs to the 
+  linearized ICP system, with the rotation about center: the update moves 
+  a point p by w x (p - center) + t."""
+  r = moved - center
+  rotationRows = numpy.zeros((len(r), 3, 3))
+  # w x r as a matrix product with w, the transposed cross product matrix of r
+  rotationRows[:,0,1], rotationRows[:,0,2] = r[:,2], -r[:,1]
+  rotationRows[:,1,0], rotationRows[:,1,2] = -r[:,2], r[:,0]
+  rotationRows[:,2,0], rotationRows[:,2,1] = r[:,1], -r[:,0]
+  translationRows = numpy.tile(numpy.identity(3), (len(r), 1, 1))
+  rows = numpy.concatenate((rotationRows, translationRows), axis=2).reshape(-1, 6)
+  return numpy.vstack((a, weight * rows)), numpy.concatenate((b, weight * (fixed - moved).ravel()))
+
+#
+# Landmark registration
+#
+
+def rigidLandmarkTransform(fixedPoints, movingPoints, similarity=False):
+  """Closed-form least-squares landmark registration (Horn/Kabsch, with the 
+  Umeyama scale when similarity is True). Both point lists are Nx3 arrays 
+  with matching rows. Returns the 4x4 matrix mapping the moving points onto 
+  the fixed points, the RMS and the per-point residual distances."""
+  fixed = numpy.asarray(fixedPoints, dtype=numpy.float64)
+  moving = numpy.asarray(movingPoints, dtype=numpy.float64)
+  if fixed.ndim != 2 or fixed.shape[1] != 3 or fixed.shape != moving.shape:
+    raise ValueError("Landmark lists must be Nx3 arrays of the same size")
+  if fixed.shape[0] < 3:
+    raise ValueError("At least 3 landmarks are needed for registration")
+  fixedCentroid = fixed.mean(axis=0)
+  movingCentroid = moving.mean(axis=0)
+  movingCentered = moving - movingCentroid
+  covariance = numpy.dot(movingCentered.T, fixed - fixedCentroid)
+  movingVariance = (movingCentered**2).sum()
+  matrix = transformFromCovariance(covariance, fixedCentroid, movingCentroid, movingVariance, similarity)
+  residuals = landmarkResiduals(matrix, fixed, moving)
+  rms = numpy.sqrt((residuals**2).mean())
+  return matrix, rms, residuals
+
+class IncrementalLandmarkRegistration:
+  """Running centroids and cross-covariance of the landmark pairs, updated 
+  in O(1) per point with Welford's scheme. solve() gives the same transform 
+  as rigidLandmarkTransform on all the points added so far."""
+  def __init__(self):
+    self.reset()
+
+  def reset(self):
+    self.count = 0
+    self.fixedCentroid = numpy.zeros(3)
+    self.movingCentroid = numpy.zeros(3)
+    self.covariance = numpy.zeros((3,3))
+    self.fixedVariance = 0.0
+    self.movingVariance = 0.0
+
+  def addPoint(self, fixedPoint, movingPoint):
+    fixedPoint = numpy.asarray(fixedPoint, dtype=numpy.float64)
+    movingPoint = numpy.asarray(movingPoint, dtype=numpy.float64)
+    self.count += 1
+    fixedDelta = fixedPoint - self.fixedCentroid
+    movingDelta = movingPoint - self.movingCentroid
+    self.fixedCentroid += fixedDelta / self.count
+    self.movingCentroid += movingDelta / self.count
+    self.covariance += numpy.outer(movingDelta, fixedPoint - self.fixedCentroid)
+    self.fixedVariance += numpy.dot(fixedDelta, fixedPoint - self.fixedCentroid)
+    self.movingVariance += numpy.dot(movingDelta, movingPoint - self.movingCentroid)
+
+  def solve(self, similarity=False):
+    """Returns the 4x4 matrix and the RMS, both computed from the sums alone."""
+    if self.count < 3:
+      raise ValueError("At least 3 landmarks are needed for registration")
+    matrix = transformFromCovariance(self.covariance, self.fixedCentroid, self.movingCentroid, self.movingVariance, similarity)
+    scaledRotation = matrix[:3,:3]
+    squaredError = self.fixedVariance + (scaledRotation**2).sum() / 3 * self.movingVariance - 2 * numpy.trace(numpy.dot(scaledRotation, self.covariance))
+    rms = numpy.sqrt(max(squaredError, 0) / self.count)
+    return matrix, rms
+
+def transformFromCovariance(covariance, fixedCentroid, movingCentroid, movingVariance=None, similarity=False):
+  """Solves the landmark transform from the 3x3 cross-covariance of the 
+  centered moving and fixed points. The determinant guard keeps the result 
+  a proper rotation when the landmarks are nearly coplanar."""
+  u, s, vt = numpy.linalg.svd(covariance)
+  d = numpy.ones(3)
+  if numpy.linalg.det(numpy.dot(vt.T, u.T)) < 0:
+    d[2] = -1
+  rotation = numpy.dot(vt.T * d, u.T)
+  scale = 1.0
+  if similarity and movingVariance:
+    scale = numpy.dot(s, d) / movingVariance
+  matrix = numpy.identity(4)
+  matrix[:3,:3] = scale * rotation
+  matrix[:3,3] = fixedCentroid - scale * numpy.dot(rotation, movingCentroid)
+  return matrix
+
+def batchTransformsFromCovariances(covariances, fixedCentroids, movingCentroids, movingVariances=None, similarity=False):
+  """transformFromCovariance for a stack of k problems: one batched SVD of 
+  the (k,3,3) covariances. Returns the (k,4,4) matrices and the (k,3) 
+  singular values."""
+  u, s, vt = numpy.linalg.svd(covariances)
+  v = vt.transpose(0, 2, 1)
+  d = numpy.ones((len(covariances), 3))
+  d[:,2] = numpy.sign(numpy.linalg.det(numpy.einsum('kab,kcb->kac', v, u)))
+  d[d[:,2] == 0, 2] = 1
+  rotations = numpy.einsum('kab,kb,kcb->kac', v, d, u)
+  scales = numpy.ones(len(covariances))
+  if similarity and movingVariances is not None:
+    scales = (s * d).sum(axis=1) / numpy.maximum(movingVariances, 1e-12)
+  matrices = numpy.zeros((len(covariances), 4, 4))
+  matrices[:,:3,:3] = scales[:,numpy.newaxis,numpy.newaxis] * rotations
+  matrices[:,:3,3] = fixedCentroids - numpy.einsum('kab,kb->ka', matrices[:,:3,:3], movingCentroids)
+  matrices[:,3,3] = 1
+  return matrices, s
+
+def subsetLandmarkTransforms(counts, fixedSums, movingSums, crossSums, movingSquareSums, similarity=False):
+  """Solves one landmark registration per subset of the landmarks, given 
+  by its (k,) point counts, (k,3) coordinate sums, (k,3,3) sums of the 
+  moving-fixed outer products and (k,) sums of the squared moving norms, 
+  so subsets are downdated from the full sums or gathered from a few 
+  points without touching every landmark."""
+  counts = numpy.asarray(counts, dtype=numpy.float64)
+  fixedCentroids = fixedSums / counts[:,numpy.newaxis]
+  movingCentroids = movingSums / counts[:,numpy.newaxis]
+  covariances = crossSums - counts[:,numpy.newaxis,numpy.newaxis] * numpy.einsum('ka,kb->kab', movingCentroids, fixedCentroids)
+  movingVariances = movingSquareSums - counts * (movingCentroids**2).sum(axis=1)
+  return batchTransformsFromCovariances(covariances, fixedCentroids, movingCentroids, movingVariances, similarity)
+
+def landmarkDiagnostics(fixedPoints, movingPoints, similarity=False, tolerance=2.0, maximumTriplets=2000):
+  """Solves every leave-one-out subset and every minimal 3-point subset in 
+  one batch to find the landmarks that do not fit the others; with more 
+  than maximumTriplets 3-point subsets, a fixed random sample of them. 
+  Returns, per landmark, the error of its prediction by the fit without 
+  it, its influence (RMS displacement of all landmarks between the full 
+  and the leave-one-out fit) and the fraction of non-degenerate 3-point 
+  fits without it that predict it within tolerance mm; then the indices 
+  of the landmarks to re-collect, worst first, and whether the landmarks 
+  agree as a whole. The prediction errors are judged after dividing out 
+  their expected growth with the distance of the landmark from the 
+  others, so an outlying but well collected landmark passes. A landmark 
+  is to be re-collected when its prediction is then more than tolerance 
+  mm off and its consistency is less than half the median one, which 
+  still singles out several bad landmarks at once. When the median 
+  prediction is off by more than tolerance, e.g. because the model 
+  fiducials are in the wrong order, the registration as a whole is 
+  inconsistent."""
+  # centered, as the errors do not depend on the origins
+  fixed = numpy.asarray(fixedPoints, dtype=numpy.float64)
+  fixed = fixed - fixed.mean(axis=0)
+  moving = numpy.asarray(movingPoints, dtype=numpy.float64)
+  moving = moving - moving.mean(axis=0)
+  n = len(fixed)
+  if n < 4:
+    return numpy.zeros(n), numpy.zeros(n), numpy.ones(n), [], True
+  if n * (n-1) * (n-2) / 6 <= maximumTriplets:
+    triplets = numpy.array(list(itertools.combinations(xrange(n), 3)))
+  else:
+    # a seeded sample keeps the diagnostics of a session repeatable
+    candidates = numpy.random.RandomState(0).randint(0, n, (2 * maximumTriplets, 3))
+    candidates.sort(axis=1)
+    distinct = (candidates[:,0] < candidates[:,1]) & (candidates[:,1] < candidates[:,2])
+    triplets = candidates[distinct][:maximumTriplets]
+  # the full fit, the leave-one-out fits downdated from its sums, and the
+  # 3-point fits gathered from their points, all solved in one batch
+  outer = moving[:,:,numpy.newaxis] * fixed[:,numpy.newaxis,:]
+  squares = (moving**2).sum(axis=1)
+  counts = numpy.concatenate(([n], numpy.repeat(n - 1, n), numpy.repeat(3, len(triplets))))
+  fixedSums = numpy.vstack((numpy.zeros((1,3)), -fixed, fixed[triplets].sum(axis=1)))
+  movingSums = numpy.vstack((numpy.zeros((1,3)), -moving, moving[triplets].sum(axis=1)))
+  crossSum = outer.sum(axis=0)
+  crossSums = numpy.concatenate((crossSum[numpy.newaxis], crossSum - outer, outer[triplets].sum(axis=1)))
+  squareSums = numpy.concatenate(([squares.sum()], squares.sum() - squares, squares[triplets].sum(axis=1)))
+  matrices, singularValues = subsetLandmarkTransforms(counts, fixedSums, movingSums, crossSums, squareSums, similarity)
+  full, leftOut, minimal = matrices[0], matrices[1:n+1], matrices[n+1:]
+  looPredicted = numpy.einsum('iab,ib->ia', leftOut[:,:3,:3], moving) + leftOut[:,:3,3]
+  looErrors = numpy.sqrt(((looPredicted - fixed)**2).sum(axis=1))
+  # RMS displacement of all landmarks between the full and each leave-one-out
+  # fit, from the second moments of the homogeneous moving landmarks
+  homogeneous = numpy.hstack((moving, numpy.ones((n,1))))
+  moments = numpy.dot(homogeneous.T, homogeneous) / n
+  differences = leftOut[:,:3,:] - full[:3,:]
+  influence = numpy.sqrt(numpy.maximum(numpy.einsum('iab,bc,iac->i', differences, moments, differences), 0))
+  # (t,n) errors of the predictions of every landmark by every 3-point fit
+  predicted = numpy.dot(minimal[:,:3,:3].reshape(-1, 3), moving.T).reshape(len(triplets), 3, n) + minimal[:,:3,3,numpy.newaxis]
+  tripletErrors = numpy.sqrt(((predicted - fixed.T)**2).sum(axis=1))
+  # nearly collinear triplets do not determine a rotation
+  valid = singularValues[n+1:,1] > 1e-3 * singularValues[n+1:,0]
+  excluded = numpy.ones((len(triplets), n), dtype=bool)
+  excluded[numpy.arange(len(triplets))[:,numpy.newaxis], triplets] = False
+  usable = excluded & valid[:,numpy.newaxis]
+  within = ((tripletErrors <= tolerance) & usable).sum(axis=0)
+  consistency = within / numpy.maximum(usable.sum(axis=0), 1).astype(numpy.float64)
+  # a left out landmark is predicted with the localization error plus the
+  # target registration error of the others at its position
+  leverage = leaveOneOutTargetRegistrationError(fixed)
+  scaledErrors = looErrors / numpy.sqrt(1 + leverage**2)
+  lowConsistency = consistency < min(0.5, 0.5 * numpy.median(consistency))
+  suspects = [int(i) for i in numpy.argsort(-scaledErrors) if scaledErrors[i] > tolerance and lowConsistency[i]]
+  return looErrors, influence, consistency, suspects, numpy.median(scaledErrors) <= tolerance
+
+def predictedTargetRegistrationError(fixedPoints, targets, localizationError):
+  """Fitzpatrick's prediction of the RMS target registration error at 
+  each target, TRE^2 = FLE^2/N (1 + 1/3 sum_k d_k^2/f_k^2), where d_k is 
+  the distance of the target from the k-th principal axis of the N 
+  fiducials and f_k the RMS distance of the fiducials from that axis. 
+  All targets are evaluated in one vectorized pass."""
+  fixed = numpy.asarray(fixedPoints, dtype=numpy.float64)
+  centroid = fixed.mean(axis=0)
+  _, _, axes = numpy.linalg.svd(fixed - centroid, full_matrices=False)
+  # squared distances from the axes, as squared norm minus squared projection
+  projected = numpy.dot(fixed - centroid, axes.T)**2
+  axisVariances = (projected.sum(axis=1)[:,numpy.newaxis] - projected).mean(axis=0)
+  # collinear fiducials leave the rotation about their axis undetermined
+  axisVariances = numpy.maximum(axisVariances, 1e-12)
+  projected = numpy.dot(numpy.asarray(targets, dtype=numpy.float64) - centroid, axes.T)**2
+  axisDistances = projected.sum(axis=1)[:,numpy.newaxis] - projected
+  ratio = numpy.dot(axisDistances, 1 / (3 * axisVariances))
+  return localizationError * numpy.sqrt((1 + ratio) / len(fixed))
+
+def leaveOneOutTargetRegistrationError(fixedPoints):
+  """predictedTargetRegistrationError at every fiducial, for a unit 
+  localization error, of the registration by the other fiducials. The 
+  leave-one-out centroids and scatter matrices are downdated from the full 
+  ones in closed form, and their principal axes found in one batch."""
+  fixed = numpy.asarray(fixedPoints, dtype=numpy.float64)
+  n = len(fixed)
+  centered = fixed - fixed.mean(axis=0)
+  scatter = numpy.dot(centered.T, centered)
+  # without point i the centroid moves by -centered_i/(n-1), and the scatter
+  # loses n/(n-1) centered_i centered_i^T
+  scatters = scatter - n / (n - 1.0) * centered[:,:,numpy.newaxis] * centered[:,numpy.newaxis,:]
+  variances, axes = numpy.linalg.eigh(scatters)
+  # mean squared distance of the other fiducials from each principal axis
+  axisVariances = numpy.maximum((variances.sum(axis=1)[:,numpy.newaxis] - variances) / (n - 1), 1e-12)
+  offsets = centered * n / (n - 1.0)
+  projected = numpy.einsum('ia,iak->ik', offsets, axes)**2
+  axisDistances = projected.sum(axis=1)[:,numpy.newaxis] - projected
+  ratio = (axisDistances / (3 * axisVariances)).sum(axis=1)
+  return numpy.sqrt((1 + ratio) / (n - 1))
+
+def localizationErrorFromRMS(rms, numberOfPoints, similarity=False):
+  """Expected RMS fiducial localization error for a registration RMS, 
+  from <FRE^2> = (1 - p/3N) FLE^2 with p the degrees of freedom."""
+  parameters = 7 if similarity else 6
+  if 3 * numberOfPoints <= parameters:
+    return rms
+  return rms * numpy.sqrt(3.0 * numberOfPoints / (3 * numberOfPoints - parameters))
+
+def matchLandmarks(fixedPoints, movingPoints, tolerance=5.0, maximumCandidates=100000, similarity=False):
+  """Finds which fixed landmark corresponds to each moving landmark when the 
+  order of the two lists cannot be trusted. Assignments are grown one 
+  landmark at a time, for all partial assignments at once, and pruned with 
+  distance invariants: the sorted distances of a landmark to the others, 
+  and the distances to the landmarks already assigned, must agree within 
+  tolerance mm. The surviving permutations are scored with one batch of 
+  rigid fits. When too many assignments survive, only the maximumCandidates 
+  with the smallest distance mismatch are kept. Returns the fixed index of 
+  each moving landmark, the RMS of the best fit and its margin to the 
+  runner-up (inf if it is the only one), or None. Without any survivor the 
+  tolerance is doubled twice before giving up."""
+  fixed = numpy.asarray(fixedPoints, dtype=numpy.float64)
+  moving = numpy.asarray(movingPoints, dtype=numpy.float64)
+  n = len(fixed)
+  fixedDistances = numpy.sqrt(((fixed[:,numpy.newaxis] - fixed)**2).sum(axis=2))
+  movingDistances = numpy.sqrt(((moving[:,numpy.newaxis] - moving)**2).sum(axis=2))
+  if similarity:
+    # compare shapes, not sizes
+    movingScale = max(movingDistances.mean(), 1e-6)
+    fixedDistances /= max(fixedDistances.mean(), 1e-6)
+    movingDistances /= movingScale
+    tolerance /= movingScale
+  for attempt in xrange(3):
+    permutations = distanceConsistentPermutations(fixedDistances, movingDistances, tolerance, maximumCandidates)
+    if len(permutations):
+      break
+    tolerance *= 2
+  else:
+    return None
+  # one batched rigid fit per surviving permutation
+  orderedFixed = fixed[permutations]
+  fixedCentroids = orderedFixed.mean(axis=1)
+  movingCentroid = moving.mean(axis=0)
+  movingCentered = moving - movingCentroid
+  covariances = numpy.einsum('ia,kib->kab', movingCentered, orderedFixed - fixedCentroids[:,numpy.newaxis])
+  k = len(permutations)
+  movingVariances = numpy.repeat((movingCentered**2).sum(), k)
+  matrices, singularValues = batchTransformsFromCovariances(covariances, fixedCentroids, numpy.tile(movingCentroid, (k,1)), movingVariances, similarity)
+  predicted = numpy.einsum('kab,ib->kia', matrices[:,:3,:3], moving) + matrices[:,numpy.newaxis,:3,3]
+  rms = numpy.sqrt(((predicted - orderedFixed)**2).sum(axis=2).mean(axis=1))
+  ranking = numpy.argsort(rms)
+  margin = rms[ranking[1]] - rms[ranking[0]] if k > 1 else numpy.inf
+  return permutations[ranking[0]], rms[ranking[0]], margin
+
+def distanceConsistentPermutations(fixedDistances, movingDistances, tolerance, maximumCandidates):
+  """(k,n) array of the assignments whose pairwise distances all agree 
+  within tolerance, row i of a permutation is the fixed index of moving i."""
+  n = len(fixedDistances)
+  fixedProfiles = numpy.sort(fixedDistances, axis=1)
+  movingProfiles = numpy.sort(movingDistances, axis=1)
+  compatible = (numpy.abs(movingProfiles[:,numpy.newaxis,:] - fixedProfiles) <= tolerance).all(axis=2)
+  # the most constrained moving landmarks first keeps the frontier small
+  order = numpy.argsort(compatible.sum(axis=1), kind='mergesort')
+  frontier = numpy.zeros((1, 0), dtype=numpy.int64)
+  mismatch = numpy.zeros(1)
+  for depth, i in enumerate(order):
+    candidates = numpy.nonzero(compatible[i])[0]
+    numberOfCandidates = len(candidates)
+    newColumn = numpy.tile(candidates, len(frontier))
+    extended = numpy.hstack((numpy.repeat(frontier, numberOfCandidates, axis=0), newColumn[:,numpy.newaxis]))
+    used = (extended[:,:-1] == newColumn[:,numpy.newaxis]).any(axis=1)
+    deviation = numpy.abs(fixedDistances[newColumn[:,numpy.newaxis], extended[:,:-1]] - movingDistances[i, order[:depth]])
+    keep = ~used & (deviation <= tolerance).all(axis=1)
+    frontier = extended[keep]
+    mismatch = numpy.repeat(mismatch, numberOfCandidates)[keep] + (deviation[keep]**2).sum(axis=1)
+    if len(frontier) > maximumCandidates:
+      best = numpy.argsort(mismatch)[:maximumCandidates]
+      frontier = frontier[best]
+      mismatch = mismatch[best]
+    if len(frontier) == 0:
+      break
+  permutations = numpy.zeros((len(frontier), n), dtype=numpy.int64)
+  if len(frontier):
+    permutations[:, order] = frontier
+  return permutations
+
+def landmarkResiduals(matrix, fixedPoints, movingPoints):
+  """Distances between the fixed points and the transformed moving points."""
+  moved = transformPoints(matrix, movingPoints)
+  return numpy.sqrt(((fixedPoints - moved)**2).sum(axis=1))
+
+def transformPoints(matrix, points):
+  """Applies a 4x4 matrix to an Nx3 array of points as a single 
+  homogeneous product on the Nx4 array."""
+  points = numpy.asarray(points, dtype=numpy.float64)
+  homogeneous = numpy.empty((len(points), 4))
+  homogeneous[:,:3] = points
+  homogeneous[:,3] = 1
+  return numpy.dot(homogeneous, matrix[:3].T)
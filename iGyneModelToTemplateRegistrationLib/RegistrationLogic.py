@@ -0,0 +1,202 @@
+"""GUI-free workflow of the iGyne model to template registration: landmark
+collection, the template transform chain, the registration and its
+diagnostics, and session files. The logic only holds numpy arrays, reading
+them from, and showing the results in, the scene is left to the widget."""
+import numpy
+from iGyneModelToTemplateRegistrationLib.Instrumentation import stageTimer
+from iGyneModelToTemplateRegistrationLib.LandmarkRegistration import defaultLandmarkNames, LandmarkStore, \
+  IncrementalLandmarkRegistration, RegistrationJob, SurfacePointIndex, landmarkDiagnostics, landmarkResiduals, \
+  localizationErrorFromRMS, matchLandmarks, predictedTargetRegistrationError, transformPoints
+from iGyneModelToTemplateRegistrationLib.TrackerRecording import dwellPoints, readTrackerRecording, streamPositions
+
+class RegistrationLogic:
+  """Collected landmarks, model landmarks and stylus sweep of one session,
+  and the registration computed from them. Points are Nx3 arrays in world
+  coordinates unless noted otherwise; model coordinates are moved to world
+  by the 4x4 matrix of the whole transform chain above the template."""
+  def __init__(self, names=defaultLandmarkNames):
+    self.landmarks = LandmarkStore(names)
+    self.incrementalRegistration = IncrementalLandmarkRegistration()
+    self.modelLandmarks = None
+    self.fixedLandmarks = None
+    self.sweepPoints = numpy.zeros((0,3))
+    self.matrix = None
+    self.rms = 0
+    self.landmarkRMS = 0
+    self.residuals = None
+    self.surfaceResult = None
+    self.surfaceNote = None
+
+  #
+  # Collection
+  #
+
+  def defineLandmarks(self, names):
+    """Starts over with one empty landmark per name."""
+    self.landmarks.define(names)
+    self.incrementalRegistration.reset()
+
+  def collectPoint(self, index, point, timestamp=0):
+    """Stores a collected landmark and adds it to the running sums in O(1)."""
+    self.landmarks.setPoint(index, point, timestamp)
+    if self.modelLandmarks is not None:
+      self.incrementalRegistration.addPoint(self.modelLandmarks[index], self.landmarks.points[index])
+
+  def resetCollection(self):
+    self.landmarks.reset()
+    self.incrementalRegistration.reset()
+
+  #
+  # Transform chain
+  #
+
+  def modelToWorld(self, points, templateToWorld=None):
+    """Moves Nx3 template model coordinates to world coordinates."""
+    points = numpy.asarray(points, dtype=numpy.float64)
+    if templateToWorld is None:
+      return points
+    return transformPoints(templateToWorld, points)
+
+  def setModelLandmarks(self, points, templateToWorld=None):
+    """Sets the model fiducials, one per landmark in template model
+    coordinates, or None. The running sums restart from the landmarks
+    collected so far."""
+    self.incrementalRegistration.reset()
+    self.modelLandmarks = None
+    if points is None:
+      return
+    self.modelLandmarks = self.modelToWorld(points, templateToWorld)
+    for i in numpy.flatnonzero(self.landmarks.collected[:len(self.landmarks)]):
+      self.incrementalRegistration.addPoint(self.modelLandmarks[i], self.landmarks.points[i])
+
+  def surfaceIndex(self, points, normals=None, templateToWorld=None):
+    """Spatial index of template model points, and normals, in world coordinates."""
+    points = self.modelToWorld(points, templateToWorld)
+    if normals is not None and templateToWorld is not None:
+      normals = numpy.dot(normals, numpy.linalg.inv(templateToWorld[:3,:3]))
+      normals /= numpy.sqrt((normals**2).sum(axis=1))[:,numpy.newaxis]
+    return SurfacePointIndex(points, normals)
+
+  #
+  # Registration
+  #
+
+  def matchCorrespondence(self, fixedPoints, similarity=False):
+    """(permutation, rms, margin) of the model fiducials matching the
+    collected landmarks by their geometry, or None. See matchLandmarks."""
+    return matchLandmarks(fixedPoints, self.landmarks.coordinates(), similarity=similarity)
+
+  def provisionalRegistration(self, similarity=False):
+    """(matrix, rms) of the landmarks collected so far, or None before the third."""
+    if self.incrementalRegistration.count < 3:
+      return None
+    with stageTimer.measure('provisional solve'):
+      return self.incrementalRegistration.solve(similarity)
+
+  def canSolveIncrementally(self, fixedPoints):
+    """Whether the running sums already cover every pair of fixedPoints."""
+    return self.modelLandmarks is not None and self.incrementalRegistration.count == len(fixedPoints) and numpy.array_equal(fixedPoints, self.modelLandmarks)
+
+  def createRegistrationJob(self, fixedPoints, similarity=False, surfaceIndex=None):
+    """Registration of the collected landmarks to fixedPoints, to be run on
+    a worker thread. With a surface index, the stylus sweep and the
+    landmarks are fitted to the surface afterwards, if the sweep is long
+    enough; see RegistrationJob.refine."""
+    self.fixedLandmarks = numpy.array(fixedPoints, dtype=numpy.float64)
+    return RegistrationJob(self.fixedLandmarks, self.landmarks.coordinates(), similarity, surfaceIndex, self.sweepPoints)
+
+  def register(self, fixedPoints, similarity=False, surfaceIndex=None):
+    """Registers on the calling thread and returns (matrix, rms, residuals)."""
+    with stageTimer.measure('solve'):
+      if surfaceIndex is None and self.canSolveIncrementally(fixedPoints):
+        self.fixedLandmarks = numpy.array(fixedPoints, dtype=numpy.float64)
+        matrix, rms = self.incrementalRegistration.solve(similarity)
+        self.surfaceResult = None
+        self.surfaceNote = None
+        self.setResult(matrix, rms, landmarkResiduals(matrix, self.fixedLandmarks, self.landmarks.coordinates()))
+        return self.matrix, self.rms, self.residuals
+      job = self.createRegistrationJob(fixedPoints, similarity, surfaceIndex)
+      job.run()
+      if job.error is not None:
+        raise job.error
+      self.surfaceResult = job.surfaceResult
+      self.surfaceNote = job.surfaceNote
+      self.setResult(*job.result, landmarkRMS=job.landmarkRMS)
+      return self.matrix, self.rms, self.residuals
+
+  def setResult(self, matrix, rms, residuals=None, landmarkRMS=None):
+    """Keeps the outcome of a registration computed elsewhere, e.g. by a job
+    or the CLI. landmarkRMS is that of the landmark fit alone, when a
+    surface refinement followed it."""
+    self.matrix = matrix
+    self.rms = rms
+    self.landmarkRMS = rms if landmarkRMS is None else landmarkRMS
+    self.residuals = residuals
+
+  def diagnose(self, similarity=False, tolerance=2.0):
+    """Leave-one-out and 3-point subset diagnostics of the last registration.
+    See landmarkDiagnostics."""
+    return landmarkDiagnostics(self.fixedLandmarks, self.landmarks.coordinates(), similarity, tolerance)
+
+  def targetRegistrationError(self, targets, localizationError=0, similarity=False):
+    """Predicted TRE at the targets and the localization error used, which
+    is estimated from the RMS of the last landmark fit when not given; the
+    RMS after a surface refinement is no least-squares landmark RMS."""
+    if not localizationError:
+      localizationError = localizationErrorFromRMS(self.landmarkRMS, len(self.fixedLandmarks), similarity)
+    return predictedTargetRegistrationError(self.fixedLandmarks, targets, localizationError), localizationError
+
+  #
+  # Session files
+  #
+
+  def saveSession(self, path, similarity=False, surfaceIndex=None):
+    """Writes the landmarks and the sweep of this session to a numpy .npz
+    file, with the template surface points and normals when a surface 
+    index is given."""
+    modelLandmarks = self.fixedLandmarks if self.fixedLandmarks is not None else self.modelLandmarks
+    arrays = {'names': numpy.array(self.landmarks.names),
+      'templateLandmarks': self.landmarks.coordinates(),
+      'modelLandmarks': modelLandmarks,
+      'sweepPoints': self.sweepPoints,
+      'similarity': numpy.array(similarity)}
+    if surfaceIndex is not None:
+      arrays['surfacePoints'] = surfaceIndex.points
+      arrays['surfaceNormals'] = surfaceIndex.normals
+    numpy.savez(path, **arrays)
+
+  def loadSession(self, path):
+    """Reads a session written by saveSession, or by hand with at least the
+    'templateLandmarks' and 'modelLandmarks' arrays, and returns the
+    transform type and the surface index, or None, it asks for."""
+    session = numpy.load(path)
+    templateLandmarks = session['templateLandmarks']
+    names = list(session['names']) if 'names' in session.files else ['%d' % (i+1) for i in xrange(len(templateLandmarks))]
+    self.defineLandmarks(names)
+    for i, point in enumerate(templateLandmarks):
+      self.landmarks.setPoint(i, point)
+    self.setModelLandmarks(session['modelLandmarks'])
+    self.sweepPoints = session['sweepPoints'] if 'sweepPoints' in session.files else numpy.zeros((0,3))
+    similarity = 'similarity' in session.files and bool(session['similarity'])
+    surfaceIndex = None
+    if 'surfacePoints' in session.files and 'surfaceNormals' in session.files:
+      surfaceIndex = SurfacePointIndex(session['surfacePoints'], session['surfaceNormals'])
+    return similarity, surfaceIndex
+
+  def loadTrackerRecording(self, path, modelLandmarks, stream='Stylus', dwellTime=1.0, dwellTolerance=0.5):
+    """Takes the landmarks of a session from the stylus dwells of its 
+    tracker recording and pairs them with the model landmarks, an Nx3 array 
+    in world coordinates. The last N dwells are used, as landmarks that 
+    were collected again come after the first attempt."""
+    names, records = readTrackerRecording(path)
+    if stream not in names:
+      raise ValueError("%s has no %s stream" % (path, stream))
+    times, positions = streamPositions(records, names.index(stream))
+    points = dwellPoints(times, positions, dwellTime, dwellTolerance)
+    n = len(modelLandmarks)
+    if len(points) < n:
+      raise ValueError("%d stylus dwells for %d model landmarks" % (len(points), n))
+    self.defineLandmarks(['%d' % (i+1) for i in xrange(n)])
+    for i, point in enumerate(points[-n:]):
+      self.landmarks.setPoint(i, point)
+    self.setModelLandmarks(modelLandmarks)
@@ -0,0 +1,359 @@
+"""Lightweight stand-ins for the parts of slicer, vtk, qt and ctk the module
+uses, so the module can be loaded and its workflow timed in plain Python.
+The scene, the transform nodes with their parent chain and events, the
+markups fiducial nodes and vtkMatrix4x4 behave like the real ones as far
+as the module relies on them. Every other widget or class is a generic
+object that accepts any call and remembers the attributes set on it.
+Model nodes have no polydata, so surface refinement and the TRE map are
+not covered."""
+import itertools
+import tempfile
+import types
+import numpy
+
+#
+# Generic widgets
+#
+
+class StandIn(object):
+  """Accepts any call or attribute access; attributes that were set keep
+  their value, all others are stand-ins themselves."""
+  def __init__(self, *args, **kwargs):
+    pass
+
+  def __call__(self, *args, **kwargs):
+    return StandIn()
+
+  def __getattr__(self, name):
+    if name.startswith('__'):
+      raise AttributeError(name)
+    child = StandIn()
+    object.__setattr__(self, name, child)
+    return child
+
+#
+# VTK
+#
+
+class Matrix4x4(object):
+  """vtkMatrix4x4 backed by a numpy array. Modifying a matrix owned by a
+  transform node fires the node's TransformModifiedEvent."""
+  def __init__(self):
+    self.elements = numpy.identity(4)
+    self.owner = None
+
+  def GetElement(self, row, column):
+    return self.elements[row, column]
+
+  def SetElement(self, row, column, value):
+    if self.elements[row, column] != value:
+      self.elements[row, column] = value
+      self.Modified()
+
+  def DeepCopy(self, other):
+    self.elements = numpy.array(other.elements if isinstance(other, Matrix4x4) else other, dtype=numpy.float64).reshape(4, 4)
+    self.Modified()
+
+  def Identity(self):
+    self.DeepCopy(numpy.identity(4))
+
+  def Modified(self):
+    if self.owner is not None:
+      self.owner.transformModified()
+
+  @staticmethod
+  def Multiply4x4(a, b, c):
+    c.DeepCopy(numpy.dot(a.elements, b.elements))
+
+def vtkModule():
+  vtk = types.ModuleType('vtk')
+  vtk.vtkMatrix4x4 = Matrix4x4
+  vtk.VTK_OBJECT = 'vtkObject'
+  return vtk
+
+#
+# MRML
+#
+
+class Node(object):
+  """MRML node with an ID, a name, attributes and observers."""
+  className = 'vtkMRMLNode'
+  ModifiedEvent = 'ModifiedEvent'
+
+  def __init__(self):
+    self.id = None
+    self.name = ''
+    self.attributes = {}
+    self.observers = {}
+    self.tags = itertools.count(1)
+    self.displayNodeID = None
+    self.hideFromEditors = False
+
+  def GetClassName(self):
+    return self.className
+
+  def IsA(self, className):
+    return any(getattr(base, 'className', None) == className for base in type(self).__mro__)
+
+  def GetID(self):
+    return self.id
+
+  def SetName(self, name):
+    self.name = name
+
+  def GetName(self):
+    return self.name
+
+  def SetScene(self, scene):
+    pass
+
+  def SetAttribute(self, name, value):
+    self.attributes[name] = value
+
+  def GetAttribute(self, name):
+    return self.attributes.get(name)
+
+  def SetHideFromEditors(self, hide):
+    self.hideFromEditors = hide
+
+  def SetAndObserveDisplayNodeID(self, nodeID):
+    self.displayNodeID = nodeID
+
+  def AddObserver(self, event, callback):
+    tag = self.tags.next()
+    self.observers[tag] = (event, callback)
+    return tag
+
+  def RemoveObserver(self, tag):
+    self.observers.pop(tag, None)
+
+  def InvokeEvent(self, event, callData=None):
+    for tag, (observed, callback) in self.observers.items():
+      if observed == event:
+        if callData is None:
+          callback(self, event)
+        else:
+          callback(self, event, callData)
+
+class TransformableNode(Node):
+  className = 'vtkMRMLTransformableNode'
+
+  def __init__(self):
+    Node.__init__(self)
+    self.scene = None
+    self.transformNodeID = None
+
+  def SetAndObserveTransformNodeID(self, nodeID):
+    parent = self.GetParentTransformNode()
+    if parent is not None:
+      parent.children.discard(self)
+    self.transformNodeID = nodeID
+    parent = self.GetParentTransformNode()
+    if parent is not None:
+      parent.children.add(self)
+    self.transformModified()
+
+  def GetTransformNodeID(self):
+    return self.transformNodeID
+
+  def GetParentTransformNode(self):
+    if self.transformNodeID is None or self.scene is None:
+      return None
+    return self.scene.GetNodeByID(self.transformNodeID)
+
+  def transformModified(self):
+    pass
+
+class TransformNode(TransformableNode):
+  className = 'vtkMRMLTransformNode'
+  TransformModifiedEvent = 15000
+
+  def __init__(self):
+    TransformableNode.__init__(self)
+    self.matrixToParent = Matrix4x4()
+    self.matrixToParent.owner = self
+    self.children = set()
+
+  def GetMatrixTransformToParent(self):
+    return self.matrixToParent
+
+  def GetMatrixTransformToWorld(self, matrix):
+    elements = self.matrixToParent.elements
+    parent = self.GetParentTransformNode()
+    while parent is not None:
+      elements = numpy.dot(parent.matrixToParent.elements, elements)
+      parent = parent.GetParentTransformNode()
+    matrix.elements = elements.copy()
+
+  def transformModified(self):
+    """Notifies the observers, then the nodes under this transform."""
+    self.InvokeEvent(self.TransformModifiedEvent)
+    for child in list(self.children):
+      child.transformModified()
+
+class LinearTransformNode(TransformNode):
+  className = 'vtkMRMLLinearTransformNode'
+
+class ModelNode(TransformableNode):
+  className = 'vtkMRMLModelNode'
+
+  def GetPolyData(self):
+    return None
+
+  def GetDisplayNode(self):
+    return None
+
+class MarkupsDisplayNode(Node):
+  className = 'vtkMRMLMarkupsDisplayNode'
+
+class MarkupsFiducialNode(TransformableNode):
+  className = 'vtkMRMLMarkupsFiducialNode'
+
+  def __init__(self):
+    TransformableNode.__init__(self)
+    self.positions = []
+    self.labels = []
+    self.modifying = 0
+
+  def GetNumberOfFiducials(self):
+    return len(self.positions)
+
+  def AddFiducial(self, x, y, z):
+    self.positions.append([x, y, z])
+    self.labels.append('')
+    self.modified()
+    return len(self.positions) - 1
+
+  def SetNthFiducialPosition(self, index, x, y, z):
+    self.positions[index] = [x, y, z]
+    self.modified()
+
+  def GetNthFiducialPosition(self, index, coordinates):
+    coordinates[:] = self.positions[index]
+
+  def SetNthFiducialLabel(self, index, label):
+    self.labels[index] = label
+    self.modified()
+
+  def GetNthFiducialLabel(self, index):
+    return self.labels[index]
+
+  def RemoveMarkup(self, index):
+    del self.positions[index]
+    del self.labels[index]
+    self.modified()
+
+  def RemoveAllMarkups(self):
+    self.positions = []
+    self.labels = []
+    self.modified()
+
+  def StartModify(self):
+    self.modifying += 1
+    return self.modifying - 1
+
+  def EndModify(self, wasModifying):
+    self.modifying = wasModifying
+    self.modified()
+
+  def modified(self):
+    if not self.modifying:
+      self.InvokeEvent(self.ModifiedEvent)
+
+class Scene(Node):
+  """vtkMRMLScene holding the nodes in order, with node added and removed
+  events that pass the node as call data."""
+  className = 'vtkMRMLScene'
+  NodeAddedEvent = 66000
+  NodeRemovedEvent = 66001
+  EndCloseEvent = 66003
+  EndImportEvent = 66005
+  BatchProcessState = 0x0001
+
+  def __init__(self):
+    Node.__init__(self)
+    self.nodes = []
+    self.nodesByID = {}
+    self.idCounts = {}
+    self.states = []
+
+  def AddNode(self, node):
+    count = self.idCounts.get(node.className, 0) + 1
+    self.idCounts[node.className] = count
+    node.id = '%s%d' % (node.className, count)
+    node.scene = self
+    self.nodes.append(node)
+    self.nodesByID[node.id] = node
+    self.InvokeEvent(self.NodeAddedEvent, node)
+    return node
+
+  def RemoveNode(self, node):
+    self.nodes.remove(node)
+    del self.nodesByID[node.id]
+    self.InvokeEvent(self.NodeRemovedEvent, node)
+
+  def GetNodeByID(self, nodeID):
+    return self.nodesByID.get(nodeID)
+
+  def GetNumberOfNodes(self):
+    return len(self.nodes)
+
+  def GetNthNode(self, index):
+    return self.nodes[index]
+
+  def IsNodePresent(self, node):
+    return node in self.nodes
+
+  def IsImporting(self):
+    return False
+
+  def StartState(self, state):
+    self.states.append(state)
+
+  def EndState(self, state):
+    self.states.remove(state)
+
+def slicerModule(scene):
+  slicer = types.ModuleType('slicer')
+  slicer.mrmlScene = scene
+  slicer.app = StandIn()
+  slicer.app.temporaryPath = tempfile.gettempdir()
+  slicer.qMRMLWidget = StandIn
+  slicer.qMRMLNodeComboBox = StandIn
+  slicer.vtkMRMLScene = Scene
+  slicer.vtkMRMLTransformNode = TransformNode
+  slicer.vtkMRMLLinearTransformNode = LinearTransformNode
+  slicer.vtkMRMLModelNode = ModelNode
+  slicer.vtkMRMLMarkupsDisplayNode = MarkupsDisplayNode
+  slicer.vtkMRMLMarkupsFiducialNode = MarkupsFiducialNode
+  slicer.modules = StandIn()
+  slicer.cli = StandIn()
+  return slicer
+
+class Installed:
+  """Puts the stand-ins where the module imports them from, the __main__
+  module, for the duration of a with block that is given the stand-in
+  scene. Whatever __main__ held under those names is put back afterwards;
+  a module loaded inside the block keeps the stand-ins it imported."""
+  names = ('vtk', 'slicer', 'qt', 'ctk')
+
+  def __init__(self, scene=None):
+    self.scene = scene if scene is not None else Scene()
+
+  def __enter__(self):
+    import __main__
+    self.saved = dict((name, getattr(__main__, name)) for name in self.names if hasattr(__main__, name))
+    __main__.vtk = vtkModule()
+    __main__.slicer = slicerModule(self.scene)
+    __main__.qt = StandIn()
+    __main__.ctk = StandIn()
+    return self.scene
+
+  def __exit__(self, exceptionType, exception, traceback):
+    import __main__
+    for name in self.names:
+      if name in self.saved:
+        setattr(__main__, name, self.saved[name])
+      else:
+        delattr(__main__, name)
+    return False
@@ -0,0 +1,129 @@
+"""Binary tracker recordings of the iGyne module: the file format, its
+writer and reader, and the landmarks found in a recorded stylus stream, so
+recorded sessions can be replayed in Slicer and registered without it.
+
+A recording is a fixed-size header followed by one fixed-size record per
+transform node update: the time in nanoseconds since the epoch, the stream
+index into the header names and the 4x4 matrix to parent."""
+import numpy
+
+trackerRecordingMagic = 'IGYNETRK'
+trackerRecordingVersion = 1
+maximumTrackerStreams = 8
+
+# fixed-size header, so the records start at a known offset
+trackerHeaderType = numpy.dtype([('magic', 'S8'), ('version', '<i4'), ('numberOfStreams', '<i4'),
+  ('count', '<i8'), ('names', 'S32', (maximumTrackerStreams,)), ('reserved', 'V232')])
+# one record per transform node update, time in nanoseconds since the epoch
+trackerRecordType = numpy.dtype([('time', '<i8'), ('stream', '<i4'), ('reserved', '<i4'), ('matrix', '<f8', (4,4))])
+
+class TrackerRecordingWriter:
+  """Appends records to a tracker recording. Records are gathered in a
+  chunk and written when it is full; the file is grown in preallocated
+  blocks and the record count in the header is updated after every chunk,
+  so a recording that was cut short is still readable."""
+  def __init__(self, path, names, chunkSize=256, preallocation=16384):
+    if len(names) > maximumTrackerStreams:
+      raise ValueError("At most %d streams can be recorded" % maximumTrackerStreams)
+    self.chunk = numpy.zeros(chunkSize, dtype=trackerRecordType)
+    self.chunkSize = chunkSize
+    self.preallocation = preallocation
+    self.count = 0
+    self.chunkCount = 0
+    self.allocated = 0
+    header = numpy.zeros(1, dtype=trackerHeaderType)
+    header['magic'] = trackerRecordingMagic
+    header['version'] = trackerRecordingVersion
+    header['numberOfStreams'] = len(names)
+    for stream, name in enumerate(names):
+      header['names'][0, stream] = name
+    self.file = open(path, 'w+b')
+    self.file.write(header.tostring())
+
+  def append(self, stream, timestamp, matrix):
+    """Adds the 4x4 matrix of one stream update at timestamp seconds."""
+    row = self.chunk[self.chunkCount]
+    row['time'] = int(timestamp * 1e9)
+    row['stream'] = stream
+    row['matrix'] = matrix
+    self.chunkCount += 1
+    if self.chunkCount == self.chunkSize:
+      self.writeChunk()
+
+  def writeChunk(self):
+    if self.chunkCount == 0:
+      return
+    if self.count + self.chunkCount > self.allocated:
+      self.allocated += self.preallocation
+      self.file.truncate(trackerHeaderType.itemsize + self.allocated * trackerRecordType.itemsize)
+    self.file.seek(trackerHeaderType.itemsize + self.count * trackerRecordType.itemsize)
+    self.file.write(self.chunk[:self.chunkCount].tostring())
+    self.count += self.chunkCount
+    self.chunkCount = 0
+    self.file.seek(trackerHeaderType.fields['count'][1])
+    self.file.write(numpy.array(self.count, dtype='<i8').tostring())
+    self.file.flush()
+
+  def close(self):
+    self.writeChunk()
+    # drop the preallocated tail
+    self.file.truncate(trackerHeaderType.itemsize + self.count * trackerRecordType.itemsize)
+    self.file.close()
+
+def readTrackerRecording(path):
+  """Stream names and the records of a tracker recording, memory mapped
+  read-only, with 'time', 'stream' and 'matrix' fields."""
+  header = numpy.fromfile(path, dtype=trackerHeaderType, count=1)
+  if len(header) == 0 or header['magic'][0] != trackerRecordingMagic:
+    raise ValueError("%s is not a tracker recording" % path)
+  names = list(header['names'][0, :header['numberOfStreams'][0]])
+  count = int(header['count'][0])
+  if count == 0:
+    return names, numpy.zeros(0, dtype=trackerRecordType)
+  records = numpy.memmap(path, dtype=trackerRecordType, mode='r', offset=trackerHeaderType.itemsize, shape=(count,))
+  return names, records
+
+def streamPositions(records, stream):
+  """Times in seconds and Nx3 translations of the records of one stream."""
+  selected = records[records['stream'] == stream]
+  return selected['time'] * 1e-9, numpy.array(selected['matrix'][:,:3,3])
+
+def dwellCenter(window, tolerance, percentile=80):
+  """The median of a window of Nx3 tip positions if the tip stayed still, 
+  i.e. percentile percent of the positions are within tolerance mm of it, 
+  else None. Unlike the largest distance, the percentile does not let a 
+  few jittery tracker frames cancel a dwell. The dwell capture of the 
+  module and dwellPoints both use this rule."""
+  center = numpy.median(window, axis=0)
+  distances = numpy.sqrt(((window - center)**2).sum(axis=1))
+  if numpy.percentile(distances, percentile) <= tolerance:
+    return center
+  return None
+
+def dwellPoints(times, positions, dwellTime=1.0, tolerance=0.5, rearmDistance=5.0, rearmWindow=0.1):
+  """The points where the tip stayed still for dwellTime seconds, by the
+  rule of the module's dwell capture: see dwellCenter, and after a capture
+  the tip has to move more than rearmDistance mm away before the next one.
+  Each point is the median over its dwell window."""
+  times = numpy.asarray(times, dtype=numpy.float64)
+  positions = numpy.asarray(positions, dtype=numpy.float64)
+  starts = numpy.searchsorted(times, times - dwellTime)
+  rearmStarts = numpy.searchsorted(times, times - rearmWindow)
+  points = []
+  lastCapture = None
+  # a dwell window starts after the tip left the last captured landmark
+  rearmTime = times[0] if len(times) else 0
+  for i in xrange(len(times)):
+    if lastCapture is not None:
+      latest = numpy.median(positions[rearmStarts[i]:i+1], axis=0)
+      if numpy.sqrt(((latest - lastCapture)**2).sum()) > rearmDistance:
+        lastCapture = None
+        rearmTime = times[i]
+      continue
+    if times[i] - rearmTime < dwellTime:
+      continue
+    center = dwellCenter(positions[starts[i]:i+1], tolerance)
+    if center is not None:
+      lastCapture = center
+      points.append(center)
+  return numpy.array(points).reshape(-1, 3)
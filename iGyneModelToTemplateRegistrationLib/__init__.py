@@ -0,0 +1,4 @@
+"""GUI-free parts of the iGyne model to template registration. Nothing in
+this package imports Slicer, Qt or VTK, so it can be used from plain Python,
+e.g. by BatchRegistration, and the Slicer module only loads it once its
+widget is created."""
@@ -0,0 +1,5 @@
+"""Tests of the registration package, run without Slicer from the module
+directory:
+
+  python -m unittest discover -s iGyneModelToTemplateRegistrationLib/tests -t .
+"""
@@ -0,0 +1,57 @@
+import imp
+import unittest
+import numpy
+import __main__
+from iGyneModelToTemplateRegistrationLib import SceneStandIns
+from iGyneModelToTemplateRegistrationLib.Benchmark import Quiet, Workflow, benchmarkLandmarks, benchmarkSession, failedChecks, modulePath
+
+class BenchmarkTest(unittest.TestCase):
+  def testRegistrationRecoversTheSyntheticOne(self):
+    for numberOfLandmarks in (6, 20):
+      row, stages = benchmarkLandmarks(numberOfLandmarks, registrations=2)
+      self.assertIn('correspondence', [stage['stage'] for stage in stages])
+      self.assertEqual(failedChecks(row, stages), [])
+
+  def testSessionDoesNotGrow(self):
+    row, stages = benchmarkSession(cycles=5)
+    self.assertEqual(row['nodesAdded'], 0)
+    self.assertEqual(failedChecks(row, stages), [])
+
+  def testChecksCatchAWrongRegistration(self):
+    row = {'landmarks': 6, 'registrationError': 3.0, 'rms': 2.5, 'noise': 0.2}
+    self.assertEqual(len(failedChecks(row)), 2)
+    self.assertEqual(len(failedChecks({'landmarks': 6, 'nodesAdded': 1, 'memoryGrowthMB': 100.0})), 2)
+
+  def testChecksCatchASlowStage(self):
+    row = {'landmarks': 20, 'registerP95Ms': 150.0}
+    stages = [{'stage': 'diagnostics', 'p95Ms': 80.0}, {'stage': 'solve', 'p95Ms': 500.0}]
+    self.assertEqual(len(failedChecks(row, stages)), 2)
+    row['landmarks'] = 100
+    self.assertEqual(failedChecks(row, stages), [])
+
+  def testStandInsAreOnlyInstalledDuringTheWorkflowSetup(self):
+    __main__.slicer = 'slicer'
+    try:
+      workflow = Workflow(6)
+      self.assertEqual(__main__.slicer, 'slicer')
+      self.assertFalse(hasattr(__main__, 'vtk'))
+      self.assertIs(workflow.module.slicer.mrmlScene, workflow.scene)
+    finally:
+      del __main__.slicer
+
+  def testNodeRegistryWorksWithoutAWidget(self):
+    with SceneStandIns.Installed():
+      module = imp.load_source('iGyneModelToTemplateRegistration', modulePath)
+    self.assertIs(module.NodeRegistry().get('Template Fiducials'), None)
+
+  def testAmbiguousCorrespondenceKeepsTheListOrder(self):
+    workflow = Workflow(6)
+    points = workflow.tips
+    with Quiet():
+      workflow.widget.logic.matchCorrespondence = lambda p, similarity: (numpy.arange(len(p))[::-1], 0.1, 0.2)
+      self.assertIs(workflow.widget.matchModelFiducials(points), points)
+      workflow.widget.logic.matchCorrespondence = lambda p, similarity: (numpy.arange(len(p))[::-1], 0.1, 5.0)
+      numpy.testing.assert_array_equal(workflow.widget.matchModelFiducials(points), points[::-1])
+
+if __name__ == '__main__':
+  unittest.main()
@@ -0,0 +1,235 @@
+import os
+import shutil
+import tempfile
+import unittest
+import numpy
+from iGyneModelToTemplateRegistrationLib.LandmarkRegistration import IncrementalLandmarkRegistration, \
+  RegistrationJob, SurfacePointIndex, landmarkDiagnostics, leaveOneOutTargetRegistrationError, localizationErrorFromRMS, \
+  matchLandmarks, predictedTargetRegistrationError, refineSurfaceRegistration, rigidLandmarkTransform, rotationFromVector, \
+  transformPoints
+from iGyneModelToTemplateRegistrationLib.RegistrationLogic import RegistrationLogic
+from iGyneModelToTemplateRegistrationLib.TrackerRecording import TrackerRecordingWriter, dwellPoints, \
+  readTrackerRecording, streamPositions
+
+def randomTransform(random, scale=1.0):
+  matrix = numpy.identity(4)
+  matrix[:3,:3] = scale * rotationFromVector(random.randn(3))
+  matrix[:3,3] = random.randn(3) * 50
+  return matrix
+
+def spherePoints(random, count, radius=40.0):
+  points = random.randn(count, 3)
+  points /= numpy.sqrt((points**2).sum(axis=1))[:,numpy.newaxis]
+  return radius * points, points.copy()
+
+class LandmarkRegistrationTest(unittest.TestCase):
+  def setUp(self):
+    self.random = numpy.random.RandomState(0)
+
+  def testIncrementalMatchesBatch(self):
+    for similarity in (False, True):
+      moving = self.random.rand(12, 3) * 80
+      fixed = transformPoints(randomTransform(self.random, 1.3 if similarity else 1.0), moving) + self.random.randn(12, 3) * 0.5
+      incremental = IncrementalLandmarkRegistration()
+      for fixedPoint, movingPoint in zip(fixed, moving):
+        incremental.addPoint(fixedPoint, movingPoint)
+      matrix, rms = incremental.solve(similarity)
+      expectedMatrix, expectedRMS, residuals = rigidLandmarkTransform(fixed, moving, similarity)
+      numpy.testing.assert_allclose(matrix, expectedMatrix, atol=1e-9)
+      self.assertAlmostEqual(rms, expectedRMS, places=9)
+
+  def testSurfaceIndexMatchesBruteForce(self):
+    points, normals = spherePoints(self.random, 5000)
+    index = SurfacePointIndex(points, normals)
+    # near the surface, inside it and far away, so every search path is taken
+    queries = numpy.vstack((points[:200] * 1.02, self.random.randn(50, 3) * 10, self.random.randn(100, 3) * 500))
+    indices, distances = index.closestPoints(queries)
+    squared = ((queries[:,numpy.newaxis,:] - points)**2).sum(axis=2)
+    numpy.testing.assert_allclose(distances, numpy.sqrt(squared.min(axis=1)), atol=1e-9)
+    numpy.testing.assert_array_equal(indices, squared.argmin(axis=1))
+
+  def testSurfaceRefinementConverges(self):
+    # an ellipsoid, so every rotation is determined by the surface
+    directions = spherePoints(self.random, 20000, 1.0)[0]
+    radii = numpy.array([60.0, 40.0, 25.0])
+    normals = directions / radii
+    normals /= numpy.sqrt((normals**2).sum(axis=1))[:,numpy.newaxis]
+    index = SurfacePointIndex(directions * radii, normals)
+    truth = numpy.identity(4)
+    truth[:3,:3] = rotationFromVector(self.random.randn(3) * 0.02)
+    truth[:3,3] = self.random.randn(3)
+    swept = index.points[self.random.permutation(len(index.points))[:500]] + self.random.randn(500, 3) * 0.2
+    sweep = transformPoints(numpy.linalg.inv(truth), swept)
+    matrix, rms, iterations, timePerIteration = refineSurfaceRegistration(index, sweep, numpy.identity(4))
+    self.assertLess(iterations, 30)
+    self.assertLess(rms, 0.3)
+    self.assertLess(numpy.abs(transformPoints(matrix, index.points) - transformPoints(truth, index.points)).max(), 0.5)
+
+  def testSurfaceRefinementNeedsASweep(self):
+    points, normals = spherePoints(self.random, 5000)
+    index = SurfacePointIndex(points, normals)
+    fixed = points[:6]
+    moving = transformPoints(numpy.linalg.inv(randomTransform(self.random)), fixed + self.random.randn(6, 3) * 0.5)
+    job = RegistrationJob(fixed, moving, surfaceIndex=index, sweepPoints=moving[:2])
+    job.run()
+    self.assertIsNone(job.surfaceResult)
+    self.assertIn('skipped', job.surfaceNote)
+    numpy.testing.assert_allclose(job.result[0], rigidLandmarkTransform(fixed, moving)[0])
+
+  def testSurfaceRefinementStaysOnTheLandmarks(self):
+    # a flat plate leaves the in-plane motion to the landmarks
+    points = numpy.zeros((5000, 3))
+    points[:,:2] = self.random.rand(5000, 2) * 120 - 60
+    normals = numpy.zeros((5000, 3))
+    normals[:,2] = 1
+    index = SurfacePointIndex(points, normals)
+    truth = randomTransform(self.random)
+    moving = transformPoints(numpy.linalg.inv(truth), points)
+    landmarks = self.random.permutation(5000)[:6]
+    sweep = moving[self.random.permutation(5000)[:300]] + self.random.randn(300, 3) * 0.2
+    job = RegistrationJob(points[landmarks], moving[landmarks] + self.random.randn(6, 3) * 0.5, surfaceIndex=index, sweepPoints=sweep)
+    job.run()
+    self.assertIsNotNone(job.surfaceResult)
+    errors = numpy.sqrt(((transformPoints(job.result[0], moving) - points)**2).sum(axis=1))
+    self.assertLess(errors.max(), 1.5)
+
+  def testMatchLandmarksRecoversPermutation(self):
+    fixed = self.random.rand(8, 3) * 80
+    permutation = self.random.permutation(8)
+    # moving landmark i was collected at fixed landmark permutation[i]
+    moving = transformPoints(numpy.linalg.inv(randomTransform(self.random)), fixed[permutation]) + self.random.randn(8, 3) * 0.2
+    match = matchLandmarks(fixed, moving)
+    self.assertIsNotNone(match)
+    numpy.testing.assert_array_equal(match[0], permutation)
+
+  def testDiagnosticsFlagSeveralBadLandmarks(self):
+    fixed = self.random.rand(8, 3) * 80
+    moving = transformPoints(numpy.linalg.inv(randomTransform(self.random)), fixed) + self.random.randn(8, 3) * 0.3
+    looErrors, influence, consistency, suspects, consistent = landmarkDiagnostics(fixed, moving)
+    self.assertEqual(suspects, [])
+    self.assertTrue(consistent)
+    for i in (1, 4):
+      offset = self.random.randn(3)
+      moving[i] += 5 * offset / numpy.sqrt((offset**2).sum())
+    looErrors, influence, consistency, suspects, consistent = landmarkDiagnostics(fixed, moving)
+    self.assertEqual(sorted(suspects), [1, 4])
+
+  def testDiagnosticsRejectWrongOrder(self):
+    fixed = self.random.rand(6, 3) * 80
+    moving = transformPoints(numpy.linalg.inv(randomTransform(self.random)), fixed[[1, 0, 3, 2, 5, 4]])
+    looErrors, influence, consistency, suspects, consistent = landmarkDiagnostics(fixed, moving)
+    self.assertFalse(consistent)
+
+  def testLeaveOneOutTargetRegistrationError(self):
+    fixed = self.random.rand(10, 3) * 80
+    others = numpy.arange(10)
+    expected = [predictedTargetRegistrationError(fixed[others != i], fixed[i:i+1], 1.0)[0] for i in xrange(10)]
+    numpy.testing.assert_allclose(leaveOneOutTargetRegistrationError(fixed), expected, rtol=1e-9)
+
+  def testTargetRegistrationErrorMatchesMonteCarlo(self):
+    fixed = self.random.rand(6, 3) * numpy.array([80, 60, 20])
+    targets = numpy.vstack((fixed.mean(axis=0), self.random.rand(4, 3) * 150 - 30))
+    sigma = 0.5
+    predicted = predictedTargetRegistrationError(fixed, targets, sigma * numpy.sqrt(3))
+    squaredErrors = numpy.zeros(len(targets))
+    trials = 2000
+    for trial in xrange(trials):
+      moving = fixed + self.random.randn(6, 3) * sigma
+      matrix = rigidLandmarkTransform(fixed, moving)[0]
+      squaredErrors += ((transformPoints(matrix, targets) - targets)**2).sum(axis=1)
+    numpy.testing.assert_allclose(numpy.sqrt(squaredErrors / trials), predicted, rtol=0.1)
+
+class RegistrationLogicTest(unittest.TestCase):
+  def setUp(self):
+    self.random = numpy.random.RandomState(1)
+    self.directory = tempfile.mkdtemp()
+
+  def tearDown(self):
+    shutil.rmtree(self.directory)
+
+  def testCollectionFillsTheFirstMissingLandmark(self):
+    logic = RegistrationLogic()
+    logic.defineLandmarks(['a', 'b', 'c', 'd'])
+    for index in (0, 2):
+      logic.collectPoint(index, self.random.rand(3))
+    self.assertEqual(logic.landmarks.nextIndex(), 1)
+    logic.collectPoint(1, self.random.rand(3))
+    logic.collectPoint(3, self.random.rand(3))
+    self.assertEqual(logic.landmarks.numberOfCollectedPoints(), 4)
+    self.assertEqual(logic.landmarks.nextIndex(), 4)
+    logic.resetCollection()
+    self.assertEqual(logic.landmarks.nextIndex(), 0)
+
+  def testSessionRoundTrip(self):
+    logic = RegistrationLogic()
+    modelLandmarks = self.random.rand(len(logic.landmarks), 3) * 80
+    collected = transformPoints(randomTransform(self.random), modelLandmarks) + self.random.randn(len(modelLandmarks), 3) * 0.3
+    logic.setModelLandmarks(modelLandmarks)
+    for i, point in enumerate(collected):
+      logic.collectPoint(i, point)
+    logic.sweepPoints = self.random.rand(50, 3)
+    points, normals = spherePoints(self.random, 500)
+    surfaceIndex = logic.surfaceIndex(points, normals)
+    matrix, rms, residuals = logic.register(modelLandmarks)
+    path = os.path.join(self.directory, 'session.npz')
+    logic.saveSession(path, True, surfaceIndex)
+
+    loaded = RegistrationLogic()
+    similarity, loadedIndex = loaded.loadSession(path)
+    self.assertTrue(similarity)
+    self.assertEqual(loaded.landmarks.names, logic.landmarks.names)
+    numpy.testing.assert_array_equal(loaded.landmarks.coordinates(), collected)
+    numpy.testing.assert_array_equal(loaded.modelLandmarks, modelLandmarks)
+    numpy.testing.assert_array_equal(loaded.sweepPoints, logic.sweepPoints)
+    numpy.testing.assert_array_equal(loadedIndex.points, points)
+    numpy.testing.assert_array_equal(loadedIndex.normals, normals)
+    loadedMatrix, loadedRMS, loadedResiduals = loaded.register(loaded.modelLandmarks)
+    numpy.testing.assert_allclose(loadedMatrix, matrix, atol=1e-9)
+
+  def testLocalizationErrorFromTheLandmarkFit(self):
+    logic = RegistrationLogic()
+    points, normals = spherePoints(self.random, 2000)
+    modelLandmarks = points[:len(logic.landmarks)]
+    transform = randomTransform(self.random)
+    collected = transformPoints(transform, modelLandmarks) + self.random.randn(len(modelLandmarks), 3) * 0.5
+    for i, point in enumerate(collected):
+      logic.collectPoint(i, point)
+    logic.sweepPoints = transformPoints(transform, points[-200:])
+    matrix, rms, residuals = logic.register(modelLandmarks, surfaceIndex=logic.surfaceIndex(points, normals))
+    self.assertIsNotNone(logic.surfaceResult)
+    landmarkRMS = rigidLandmarkTransform(modelLandmarks, collected)[1]
+    self.assertNotAlmostEqual(rms, landmarkRMS)
+    errors, localizationError = logic.targetRegistrationError(modelLandmarks)
+    self.assertAlmostEqual(localizationError, localizationErrorFromRMS(landmarkRMS, len(modelLandmarks)))
+
+  def testTrackerRecordingRoundTrip(self):
+    path = os.path.join(self.directory, 'session.trk')
+    tips = self.random.rand(4, 3) * 80
+    writer = TrackerRecordingWriter(path, ['Reference', 'Stylus'], chunkSize=16, preallocation=100)
+    now = 100.0
+    for tip in tips:
+      # one second still on every landmark, a jump to the next one
+      for frame in xrange(150):
+        now += 0.01
+        matrix = numpy.identity(4)
+        matrix[:3,3] = tip + self.random.randn(3) * 0.05
+        writer.append(1, now, matrix)
+        writer.append(0, now, numpy.identity(4))
+    writer.close()
+    names, records = readTrackerRecording(path)
+    self.assertEqual(names, ['Reference', 'Stylus'])
+    self.assertEqual(len(records), 2 * 150 * len(tips))
+    times, positions = streamPositions(records, 1)
+    numpy.testing.assert_allclose(times[:2], [100.01, 100.02])
+    numpy.testing.assert_allclose(dwellPoints(times, positions), tips, atol=0.05)
+
+  def testDwellPointsIgnoreJitteryFrames(self):
+    tips = self.random.rand(5, 3) * 80
+    times = numpy.arange(150 * len(tips)) * 0.01
+    positions = numpy.repeat(tips, 150, axis=0) + self.random.randn(len(times), 3) * 0.2
+    # one tracker frame in forty is 5 mm off
+    positions[7::40] += 3.0
+    numpy.testing.assert_allclose(dwellPoints(times, positions), tips, atol=0.1)
+
+if __name__ == '__main__':
+  unittest.main()